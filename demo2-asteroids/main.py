@@ -6,9 +6,16 @@
 # https://discord.gg/3NFfvHAt44
 # Be a part of the revolution/ create your own
 # pygame games for the Web!
+import array
+import collections
+import json
 import math
 import random
 import katagames_sdk.engine as kataen
+try:
+    import numpy as np
+except ImportError:  # XXX numpy isn't available in web mode~
+    np = None
 
 pygame = kataen.import_pygame()
 CogObject = kataen.CogObject
@@ -16,13 +23,18 @@ EventReceiver = kataen.EventReceiver
 EngineEvTypes = kataen.EngineEvTypes
 SCR_SIZE = [0, 0]
 NB_ROCKS = 9
-bullets = list()
+bullets = None
 FG_COLOR = (119, 255, 0)
+ASSET_COLORKEYS = {'rock.png': (0xff, 0, 0xff)}
 music_snd = None
 view = ctrl = None
+resources = None
 
 
 class Vector2d:
+    """pygame.Vector2 isn't available in web mode, in-place methods (*_ip) are there to avoid allocations"""
+    __slots__ = ('x', 'y')
+
     def __init__(self, x=0.0, y=0.0):
         self.x, self.y = float(x), float(y)
 
@@ -32,15 +44,36 @@ class Vector2d:
         coord_y = math.sin(theta)
         return cls(coord_x, coord_y)
 
+    def set(self, x, y):
+        self.x, self.y = float(x), float(y)
+
+    def set_from_angle(self, theta):
+        self.x = math.cos(theta)
+        self.y = math.sin(theta)
+
+    def iadd(self, other_vect):
+        self.x += other_vect.x
+        self.y += other_vect.y
+
+    def __iadd__(self, other_vect):
+        self.iadd(other_vect)
+        return self
+
+    def scale_ip(self, facteur):
+        self.x *= facteur
+        self.y *= facteur
+
+    def rotate_ip(self, theta):
+        c, s = math.cos(theta), math.sin(theta)
+        self.x, self.y = self.x * c - self.y * s, self.x * s + self.y * c
+
     def get_int_coords(self):
         return int(self.x), int(self.y)
 
     def length(self):
         return math.sqrt(self.x ** 2 + self.y ** 2)
 
-    def multiply(self, facteur):
-        self.x *= facteur
-        self.y *= facteur
+    multiply = scale_ip
 
     @property
     def rtuple(self):
@@ -53,18 +86,201 @@ class Vector2d:
         return self.__class__(self.x + other_vect.x, self.y + other_vect.y)
 
 
+class BulletPool:
+    """
+        Fixed capacity storage for bullets, as parallel arrays (no numpy in web mode).
+        Live bullets are packed in slots [0, n), a dead bullet being replaced by the last one, so nothing is allocated.
+    """
+    def __init__(self, capacity=512, lifetime=400):
+        self.capacity = capacity
+        self.lifetime = lifetime  # in logic updates
+        self.n = 0
+        self.x = array.array('d', bytes(8 * capacity))
+        self.y = array.array('d', bytes(8 * capacity))
+        self.vx = array.array('d', bytes(8 * capacity))
+        self.vy = array.array('d', bytes(8 * capacity))
+        self.ttl = array.array('i', bytes(4 * capacity))
+
+    def __len__(self):
+        return self.n
+
+    def add(self, x, y, vx, vy):
+        """returns False when the pool is full, the bullet being dropped"""
+        i = self.n
+        if i == self.capacity:
+            return False
+        self.x[i], self.y[i], self.vx[i], self.vy[i] = x, y, vx, vy
+        self.ttl[i] = self.lifetime
+        self.n += 1
+        return True
+
+    def kill(self, i):
+        last = self.n - 1
+        if i != last:
+            self.x[i], self.y[i], self.vx[i], self.vy[i] = self.x[last], self.y[last], self.vx[last], self.vy[last]
+            self.ttl[i] = self.ttl[last]
+        self.n = last
+
+    def kill_many(self, indices):
+        for i in sorted(indices, reverse=True):
+            self.kill(i)
+
+    def update(self, width, height):
+        """moves every bullet by its speed, bullets that leave [0, width) x [0, height) or get too old are killed"""
+        xs, ys, vxs, vys, ttls = self.x, self.y, self.vx, self.vy, self.ttl
+        i = 0
+        while i < self.n:
+            x, y, t = xs[i] + vxs[i], ys[i] + vys[i], ttls[i] - 1
+            if t <= 0 or not (0 <= x < width and 0 <= y < height):
+                self.kill(i)  # slot i now holds the last bullet, which hasn't moved yet
+                continue
+            xs[i], ys[i], ttls[i] = x, y, t
+            i += 1
+
+    def get_pos(self, i):
+        return self.x[i], self.y[i]
+
+
+class CollisionGrid:
+    """
+        Broad phase for point vs rect tests: rects are registered in every square cell they overlap,
+        so a point only has to be tested against the rects of its own cell.
+    """
+    NP_THRESHOLD = 64  # below this many candidate pairs, the narrow phase isn't worth vectorizing
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.rects = []
+        self._cells = dict()  # (cx, cy) -> indices of the rects overlapping that cell
+        self._bounds = None  # left, top, right, bottom numpy columns of the rects, for the vectorized narrow phase
+
+    def rebuild(self, rects):
+        self.rects = rects
+        if np is not None:
+            boxes = np.array([tuple(r) for r in rects], dtype=np.int64).reshape(-1, 4)
+            self._bounds = (boxes[:, 0], boxes[:, 1], boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3])
+        cells = self._cells = dict()
+        cs = self.cell_size
+        for i, r in enumerate(rects):
+            for cx in range(r.left // cs, (r.right - 1) // cs + 1):
+                for cy in range(r.top // cs, (r.bottom - 1) // cs + 1):
+                    bucket = cells.get((cx, cy))
+                    if bucket is None:
+                        cells[(cx, cy)] = [i]
+                    else:
+                        bucket.append(i)
+
+    def candidates(self, x, y):
+        """indices of the rects that may contain the point. Coordinates are truncated like Rect.collidepoint does"""
+        return self._cells.get((int(x) // self.cell_size, int(y) // self.cell_size), ())
+
+    def candidate_pairs(self, xs, ys, n):
+        """
+            (rect indices, point indices), parallel lists of the rects sharing a cell with each of
+            the first n points of xs, ys
+        """
+        rect_idx = []
+        point_idx = []
+        cells, cs = self._cells, self.cell_size
+        for j in range(n):
+            bucket = cells.get((int(xs[j]) // cs, int(ys[j]) // cs))
+            if bucket:
+                rect_idx += bucket
+                point_idx += [j] * len(bucket)
+        return rect_idx, point_idx
+
+    def narrow_phase(self, pairs, xs, ys):
+        """the (rect index, point index) pairs whose point really lies in the rect"""
+        rect_idx, point_idx = pairs
+        if np is None or len(rect_idx) < self.NP_THRESHOLD:
+            rects = self.rects
+            return [(i, j) for i, j in zip(rect_idx, point_idx) if rects[i].collidepoint((xs[j], ys[j]))]
+        left, top, right, bottom = self._bounds
+        ri = np.array(rect_idx, dtype=np.int64)
+        pj = np.array(point_idx, dtype=np.int64)
+        px = np.asarray(xs, dtype=np.float64)[pj].astype(np.int64)  # truncated, as by collidepoint
+        py = np.asarray(ys, dtype=np.float64)[pj].astype(np.int64)
+        inside = (left[ri] <= px) & (px < right[ri]) & (top[ri] <= py) & (py < bottom[ri])
+        return list(zip(ri[inside].tolist(), pj[inside].tolist()))
+
+    def query_point(self, xy):
+        return [i for i in self.candidates(xy[0], xy[1]) if self.rects[i].collidepoint(xy)]
+
+
+class ResourceCache:
+    """
+        Loads each image or sound once, and hands out shared references to it. References are counted:
+        resources nobody holds anymore are kept, up to max_unused of them, then evicted least recently released first.
+        Images get converted to the display format when there is a display, and get their colorkey from colorkeys.
+    """
+    SOUND_EXTENSIONS = ('wav', 'ogg', 'mp3')
+
+    def __init__(self, base_dir='assets', colorkeys=ASSET_COLORKEYS, max_unused=16):
+        self.base_dir = base_dir
+        self.colorkeys = colorkeys
+        self.max_unused = max_unused
+        self._resources = dict()  # name -> image or sound
+        self._refs = dict()
+        self._unused = collections.OrderedDict()  # names of the resources with no reference, in release order
+
+    def _load(self, name):
+        path = '{}/{}'.format(self.base_dir, name)
+        if name.rsplit('.', 1)[-1].lower() in self.SOUND_EXTENSIONS:
+            return pygame.mixer.Sound(path)
+        img = pygame.image.load(path)
+        colorkey = self.colorkeys.get(name)
+        if pygame.display.get_surface() is not None:
+            # colorkeyed images never need per-pixel alpha. XXX pygame.SRCALPHA doesn't exist in web mode~
+            has_alpha = colorkey is None and img.get_flags() & getattr(pygame, 'SRCALPHA', 0)
+            img = img.convert_alpha() if has_alpha else img.convert()
+        if colorkey is not None:
+            img.set_colorkey(colorkey)
+        return img
+
+    def _get(self, name):
+        res = self._resources.get(name)
+        if res is None:
+            res = self._resources[name] = self._load(name)
+            self._refs[name] = 0
+        return res
+
+    def acquire(self, name):
+        res = self._get(name)
+        self._refs[name] += 1
+        self._unused.pop(name, None)
+        return res
+
+    def release(self, name):
+        self._refs[name] -= 1
+        if self._refs[name] == 0:
+            self._set_unused(name)
+
+    def _set_unused(self, name):
+        self._unused[name] = None
+        while len(self._unused) > self.max_unused:
+            evicted, _ = self._unused.popitem(last=False)
+            del self._resources[evicted]
+            del self._refs[evicted]
+
+    def preload(self, names):
+        for name in names:
+            if name not in self._resources:
+                self._get(name)
+                self._set_unused(name)
+
+    def preload_list(self, path='assets.json'):
+        """loads the files listed by the web packager, e.g. at startup"""
+        with open(path) as f:
+            self.preload(json.load(f))
+
+
 class RockSprite(pygame.sprite.Sprite):
-    snd = None
 
     def __init__(self):
         super().__init__()
-        if self.__class__.snd:
-            pass
-        else:
-            self.__class__.snd = pygame.mixer.Sound('assets/explosion_002.wav')
-            self.__class__.snd.set_volume(0.66)
-        self.image = pygame.image.load('assets/rock.png')
-        self.image.set_colorkey((0xff, 0, 0xff))
+        self.snd = resources.acquire('explosion_002.wav')
+        self.snd.set_volume(0.66)
+        self.image = resources.acquire('rock.png')
         pos = [random.randint(0, SCR_SIZE[0] - 1), random.randint(0, SCR_SIZE[1] - 1)]
         self.rect = self.image.get_rect()
         self.rect.topleft = pos
@@ -75,7 +291,9 @@ class RockSprite(pygame.sprite.Sprite):
         self.immunity = 0
 
     def destroyed(self):
-        self.__class__.snd.play(0)
+        self.snd.play(0)
+        resources.release('explosion_002.wav')
+        resources.release('rock.png')
 
     def update(self):
         if self.immunity:
@@ -109,9 +327,12 @@ class ShipModel(CogObject):
 
     def __init__(self):
         super().__init__()
-        self._position = None
+        self._position = Vector2d()
         self._angle = None
-        self._speed = None
+        self._speed = Vector2d()
+        self._unit = Vector2d()  # cos and sin of self._angle
+        self._pts_angle = None  # angle for which _pts_offsets were computed
+        self._pts_offsets = None
         self.reset()
 
     @property
@@ -119,40 +340,43 @@ class ShipModel(CogObject):
         return self._position.rtuple
 
     def reset(self):
-        initpos = (SCR_SIZE[0] // 2, SCR_SIZE[1] // 2)
-        self._position = Vector2d(*initpos)
-        self._angle = 0
-        self._speed = Vector2d()
+        self._position.set(SCR_SIZE[0] // 2, SCR_SIZE[1] // 2)
+        self._set_angle(0)
+        self._speed.set(0.0, 0.0)
+
+    def _set_angle(self, angle):
+        self._angle = angle
+        self._unit.set_from_angle(angle)
 
     def three_pt_repr(self):
-        orientation = -self._angle
-        pt_central = self._position.rtuple
-        temp = [Vector2d.new_from_angle(orientation - (2.0 * math.pi / 3)),
-                Vector2d.new_from_angle(orientation),
-                Vector2d.new_from_angle(orientation + (2.0 * math.pi / 3))]
-        for tv in temp:
-            tv.y *= -1
-        temp[0].multiply(1.2 * self.RAD)
-        temp[1].multiply(3 * self.RAD)
-        temp[2].multiply(1.2 * self.RAD)
-        pt_li = [Vector2d(*pt_central),
-                 Vector2d(*pt_central),
-                 Vector2d(*pt_central)]
-        for i in range(3):
-            pt_li[i] += temp[i]
-        return pt_li[0].rtuple, pt_li[1].rtuple, pt_li[2].rtuple
+        if self._pts_angle != self._angle:
+            orientation = -self._angle
+            offsets = []
+            for theta, scale in ((orientation - (2.0 * math.pi / 3), 1.2 * self.RAD),
+                                 (orientation, 3 * self.RAD),
+                                 (orientation + (2.0 * math.pi / 3), 1.2 * self.RAD)):
+                offsets.append((math.cos(theta) * scale, (math.sin(theta) * -1) * scale))
+            self._pts_offsets = offsets
+            self._pts_angle = self._angle
+        x, y = self._position.x, self._position.y
+        off = self._pts_offsets
+        return (x + off[0][0], y + off[0][1]), (x + off[1][0], y + off[1][1]), (x + off[2][0], y + off[2][1])
+
+    def _set_speed(self, speedv):
+        """speed vector of length speedv, along the ship's orientation"""
+        self._speed.x = self._unit.x
+        self._speed.y = self._unit.y
+        self._speed.scale_ip(speedv)
 
     def _update_speed_vect(self):
-        lg = self._speed.length()
-        self._speed = Vector2d.new_from_angle(self._angle)
-        self._speed.multiply(lg)
+        self._set_speed(self._speed.length())
 
     def ccw_rotate(self):
-        self._angle -= self.__class__.DELTA_ANGLE
+        self._set_angle(self._angle - self.__class__.DELTA_ANGLE)
         self._update_speed_vect()
 
     def cw_rotate(self):
-        self._angle += self.__class__.DELTA_ANGLE
+        self._set_angle(self._angle + self.__class__.DELTA_ANGLE)
         self._update_speed_vect()
 
     def get_orientation(self):
@@ -160,24 +384,21 @@ class ShipModel(CogObject):
 
     def accel(self):
         if self._speed.length() == 0:
-            self._speed = Vector2d.new_from_angle(self._angle)
-            self._speed.multiply(5)
+            self._set_speed(5)
         else:
             speedv_now = self._speed.length()
             speedv_now += 1
             if speedv_now > self.SPEED_CAP:
                 speedv_now = self.SPEED_CAP
-            self._speed = Vector2d.new_from_angle(self._angle)
-            self._speed.multiply(speedv_now)
+            self._set_speed(speedv_now)
 
     def brake(self):
         speedv_now = self._speed.length()
         speedv_now = speedv_now * 0.96
         if speedv_now < 5:
-            self._speed = Vector2d()
+            self._speed.set(0.0, 0.0)
             return
-        self._speed = Vector2d.new_from_angle(self._angle)
-        self._speed.multiply(speedv_now)
+        self._set_speed(speedv_now)
 
     def get_position(self):
         return self._position
@@ -199,11 +420,8 @@ class ShipModel(CogObject):
         self._position.x = x
         self._position.y = y
 
-    def shoot(self):
-        sh_pos = self._position.clone()
-        b_speed = Vector2d.new_from_angle(self._angle)
-        b_speed.multiply(3)
-        return sh_pos, b_speed
+    def shoot(self, pool):
+        pool.add(self._position.x, self._position.y, self._unit.x * 3, self._unit.y * 3)
 
 
 class ShipCtrl(EventReceiver):
@@ -212,6 +430,7 @@ class ShipCtrl(EventReceiver):
         self._ref_ship = ref_mod
         self._ref_rocks = rocksm
         self.last_tick = None
+        self._grid = CollisionGrid()
 
     def proc_event(self, ev, source):
         if ev.type == EngineEvTypes.LOGICUPDATE:
@@ -230,52 +449,93 @@ class ShipCtrl(EventReceiver):
                 tmp = 0
             self.last_tick = ev.curr_t
             self._ref_ship.update(tmp)
-            for b in bullets:
-                b[0].x += b[1].x
-                b[0].y += b[1].y
+            bullets.update(SCR_SIZE[0], SCR_SIZE[1])
+
+            # every rock is hit by its colliding bullet of lowest index
+            grid = self._grid
+            grid.rebuild([elt.rect for elt in self._ref_rocks])
+            first_hit = dict()
+            for i, j in grid.narrow_phase(grid.candidate_pairs(bullets.x, bullets.y, bullets.n), bullets.x, bullets.y):
+                if j < first_hit.get(i, bullets.n):
+                    first_hit[i] = j
+            ship_hits = set(grid.query_point(self._ref_ship.pos))
+
             remove = set()
             rb = set()
-            for elt in self._ref_rocks:
-                for idx, b in enumerate(bullets):
-                    if elt.rect.collidepoint(b[0].rtuple):
-                        remove.add(elt)
-                        elt.zombie = True
-                        rb.add(idx)
-                        break
+            for i, elt in enumerate(self._ref_rocks):
+                if i in first_hit:
+                    remove.add(elt)
+                    elt.zombie = True
+                    rb.add(first_hit[i])
                 if not elt.zombie and not elt.immunity:
-                    if elt.rect.collidepoint(self._ref_ship.pos):
+                    if i in ship_hits:
                         elt.inv_speed()
                         self._ref_ship.reset()
+                        ship_hits = set(grid.query_point(self._ref_ship.pos))  # rocks not updated yet vs new pos
                 elt.update()
             if len(remove):
                 for tmp in remove:
                     tmp.destroyed()
-                    self._ref_rocks.remove(tmp)
-                rbplus = list(rb)
-                rbplus.sort(reverse=True)
-                while len(rbplus) > 0:
-                    del bullets[rbplus.pop()]
+                self._ref_rocks[:] = [elt for elt in self._ref_rocks if not elt.zombie]
+                bullets.kill_many(rb)
         elif ev.type == pygame.KEYDOWN:
             if ev.key == pygame.K_SPACE:
-                bullets.append(self._ref_ship.shoot())
+                self._ref_ship.shoot(bullets)
 
 
 class TinyWorldView(EventReceiver):
+    """
+        Draws rocks and bullets with a single Surface.blits call, bullets being stamped from a pre-drawn image.
+        Only the areas drawn on the previous frame are cleared, the engine still presents the whole screen.
+        The whole screen is filled instead after request_full_redraw() (e.g. when something else painted over it),
+        when the screen changes, or when the previous frame covered so much of the screen that a single fill is cheaper.
+    """
+    MAX_DIRTY_RATIO = 0.25  # of the screen area
     BG_COLOR = (0, 10, 0)
+    BULLET_RADIUS = 3
 
     def __init__(self, ship_model, rocksm):
         super().__init__()
         self.ship = ship_model
         self.ref_rocksm = rocksm
+        self._drawn_rects = []
+        self._bg = None
+        self._full_redraw = True
+
+        r = self.BULLET_RADIUS
+        self._bullet_img = pygame.Surface((2 * r, 2 * r))
+        self._bullet_img.fill(self.BG_COLOR)
+        self._bullet_img.set_colorkey(self.BG_COLOR)
+        pygame.draw.circle(self._bullet_img, FG_COLOR, (r, r), r, 0)
+
+    def request_full_redraw(self):
+        self._full_redraw = True
 
     def proc_event(self, ev, source):
         if ev.type == EngineEvTypes.PAINT:
-            ev.screen.fill(self.BG_COLOR)
-            for rock_spr in self.ref_rocksm:
-                ev.screen.blit(rock_spr.image, rock_spr.rect.topleft)
-            for b in bullets:
-                pygame.draw.circle(ev.screen, FG_COLOR, b[0].rtuple, 3, 0)
-            pygame.draw.polygon(ev.screen, FG_COLOR, self.ship.three_pt_repr(), 4)
+            screen = ev.screen
+            if self._bg is None or self._bg.get_size() != screen.get_size():
+                self._bg = pygame.Surface(screen.get_size())
+                self._bg.fill(self.BG_COLOR)
+                self._full_redraw = True
+            if self._full_redraw:
+                screen.blit(self._bg, (0, 0))
+                self._full_redraw = False
+            else:
+                screen.blits([(self._bg, rect, rect) for rect in self._drawn_rects], False)
+
+            r = self.BULLET_RADIUS
+            bullet_img = self._bullet_img
+            xs, ys = bullets.x, bullets.y
+            seq = [(rock_spr.image, rock_spr.rect) for rock_spr in self.ref_rocksm]
+            # same pixels as pygame.draw.circle at a float center, which gets truncated
+            seq.extend([(bullet_img, (int(xs[i]) - r, int(ys[i]) - r)) for i in range(bullets.n)])
+            drawn = screen.blits(seq)
+            drawn.append(pygame.draw.polygon(screen, FG_COLOR, self.ship.three_pt_repr(), 4))
+
+            self._drawn_rects = drawn
+            if sum(rect.w * rect.h for rect in drawn) > self.MAX_DIRTY_RATIO * screen.get_width() * screen.get_height():
+                self._full_redraw = True
 
 
 def print_mini_tutorial():
@@ -291,7 +551,7 @@ def print_mini_tutorial():
 class IntroV(EventReceiver):
     def __init__(self):
         super().__init__()
-        self.img = pygame.image.load('assets/enter_start.png')
+        self.img = resources.acquire('enter_start.png')
         self.dim = self.img.get_size()
         self.painting = True
 
@@ -303,17 +563,21 @@ class IntroV(EventReceiver):
                 ev.screen.blit(self.img, ((SCR_SIZE[0] - self.dim[0]) // 2, (SCR_SIZE[1] - self.dim[1]) // 2))
             elif ev.type == pygame.KEYDOWN and ev.key == pygame.K_RETURN:
                 self.painting = False
+                view.request_full_redraw()  # the intro screen is still there
                 print_mini_tutorial()
                 pygame.mixer.init()
-                music_snd = pygame.mixer.Sound('assets/ndimensions-zik.ogg')
+                music_snd = resources.acquire('ndimensions-zik.ogg')
                 music_snd.set_volume(0.25)
                 music_snd.play(-1)
 
 
 def run_game():
-    global SCR_SIZE, view, ctrl
+    global SCR_SIZE, view, ctrl, bullets, resources
     kataen.init(kataen.OLD_SCHOOL_MODE)
     SCR_SIZE = kataen.get_screen().get_size()
+    bullets = BulletPool()
+    resources = ResourceCache()
+    resources.preload_list()
     introv = IntroV()
     shipm = ShipModel()
     li = [RockSprite() for _ in range(NB_ROCKS)]
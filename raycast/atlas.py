@@ -0,0 +1,96 @@
+"""
+Packs sprites into a single atlas image, and writes the frame rects read by main.Art (assets/atlas.json).
+The input spec lists the frames, either whole images or rects of existing sheets, and how they are grouped:
+
+    {
+      "colorkey": [255, 0, 255],
+      "frames": {"enemy_0": "sprites/skulker.png", "pickup_0": ["old_sheet.png", 0, 32, 16, 32]},
+      "groups": {"ENEMIES": ["enemy_0"], "PICKUPS": ["pickup_0"]}
+    }
+
+    python atlas.py spec.json --image assets/art.png --out assets/atlas.json
+"""
+import argparse
+import json
+import os
+import sys
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+
+def pack_rects(sizes, max_width, padding=0):
+    """
+        shelf packing: rects are placed left to right, tallest first, starting a new shelf when a row is full.
+        Returns the (x, y) of every size, in the input order, and the (width, height) of the atlas
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    x = y = shelf_h = width = 0
+    for i in order:
+        w, h = sizes[i]
+        if x > 0 and x + w > max_width:
+            x, y = 0, y + shelf_h + padding
+            shelf_h = 0
+        positions[i] = (x, y)
+        x += w + padding
+        shelf_h = max(shelf_h, h)
+        width = max(width, x - padding)
+    return positions, (width, y + shelf_h)
+
+
+def load_frames(spec, base_dir):
+    sheets = dict()
+    frames = dict()
+    for name, src in spec['frames'].items():
+        path, rect = (src, None) if isinstance(src, str) else (src[0], src[1:5])
+        if path not in sheets:
+            sheets[path] = pygame.image.load(os.path.join(base_dir, path))
+        frames[name] = sheets[path] if rect is None else sheets[path].subsurface(rect)
+    return frames
+
+
+def build_atlas(spec, base_dir, image_name, max_width=256, padding=0):
+    """returns the atlas Surface, and the atlas description to save as JSON"""
+    colorkey = tuple(spec.get('colorkey', (0xFF, 0x00, 0xFF)))
+    frames = load_frames(spec, base_dir)
+    names = list(frames.keys())
+    positions, size = pack_rects([frames[name].get_size() for name in names], max_width, padding)
+
+    atlas = pygame.Surface(size)
+    atlas.fill(colorkey)
+    rects = dict()
+    for name, pos in zip(names, positions):
+        atlas.blit(frames[name], pos)
+        rects[name] = [pos[0], pos[1], frames[name].get_width(), frames[name].get_height()]
+    desc = {'image': image_name, 'colorkey': list(colorkey), 'frames': rects, 'groups': spec.get('groups', {})}
+    return atlas, desc
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Sprite atlas builder")
+    parser.add_argument('spec', help="JSON spec of the frames to pack")
+    parser.add_argument('--image', default='assets/art.png', help="atlas image to write")
+    parser.add_argument('--out', default='assets/atlas.json', help="atlas description to write")
+    parser.add_argument('--max-width', type=int, default=256)
+    parser.add_argument('--padding', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    atlas, desc = build_atlas(spec, os.path.dirname(os.path.abspath(args.spec)), os.path.basename(args.image),
+                              args.max_width, args.padding)
+    pygame.image.save(atlas, args.image)
+    with open(args.out, 'w') as f:
+        json.dump(desc, f, indent=2)
+    print("{}: {}x{}, {} frames".format(args.image, atlas.get_width(), atlas.get_height(), len(desc['frames'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
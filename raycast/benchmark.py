@@ -0,0 +1,176 @@
+"""
+Headless benchmark for the raycaster: no window is opened (dummy SDL video driver + offscreen Surface).
+Every case builds a seeded map with build_game_state, replays the same scripted input trace through
+RayCasterGame.advance, and measures update and render ms/frame separately.
+
+    python benchmark.py --out results.json
+    python benchmark.py --out results.json --baseline baseline.json   # exit code 1 on regression
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --sweep parallel.json   # e.g. {"n_rays": [320, 1280], "n_workers": [0, 4]}
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+INVOCATION_DIR = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # assets are loaded with relative paths
+
+import main
+
+pygame = main.pygame
+
+DT = 1 / 60
+RENDERERS = {
+    '2d': main.RayCastRenderer,
+    '3d': main.RayCastRenderer3D,
+    '3d_buffer': main.ColumnBufferRenderer3D,
+}
+DEFAULT_SWEEP = {
+    'n_rays': [60, 320],
+    'grid_dims': [(64, 48), (256, 256)],
+    'cell_size': [16],
+    'n_enemies': [4, 64],
+    'sight': [200, 800],
+    'renderer': ['3d'],
+}
+
+
+def make_input_trace(n_frames, seed, hold=30):
+    """(forward, strafe, turn) for every frame, each random input being held for `hold` frames"""
+    rng = random.Random(seed)
+    trace = []
+    while len(trace) < n_frames:
+        step = (rng.choice((-1, 0, 1, 1)), rng.choice((-1, 0, 0, 1)), rng.choice((-1, 0, 1)))
+        trace.extend([step] * hold)
+    return trace[:n_frames]
+
+
+def percentile(values, q):
+    data = sorted(values)
+    return data[min(len(data) - 1, int(q / 100 * len(data)))]
+
+
+def summarize(values):
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values),
+    }
+
+
+def case_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def run_case(params, n_frames, seed, screen_size):
+    random.seed(seed)
+    game = main.RayCasterGame()
+    game.state = main.build_game_state(grid_dims=tuple(params['grid_dims']), cell_size=params['cell_size'],
+                                       n_enemies=params['n_enemies'], n_rays=params['n_rays'],
+                                       sight=params['sight'])
+    game.renderer = RENDERERS[params['renderer']]()
+    if params.get('n_workers'):  # not in the default sweep, so that older baselines keep matching
+        game.state.enable_parallel_casting(params['n_workers'])
+    screen = pygame.Surface(screen_size)
+
+    update_ms, render_ms = [], []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # enemies print their mood changes
+            for forward, strafe, turn in make_input_trace(n_frames, seed):
+                t0 = time.perf_counter()
+                game.advance(forward, strafe, turn, DT)
+                t1 = time.perf_counter()
+                screen.fill((0, 0, 0))
+                game.renderer.render(screen, game.state)
+                t2 = time.perf_counter()
+                update_ms.append((t1 - t0) * 1000)
+                render_ms.append((t2 - t1) * 1000)
+    finally:
+        game.state.close()
+
+    return {'params': params, 'update_ms': summarize(update_ms), 'render_ms': summarize(render_ms)}
+
+
+def iter_cases(sweep):
+    names = sorted(sweep.keys())
+    for values in itertools.product(*(sweep[name] for name in names)):
+        params = dict(zip(names, values))
+        if isinstance(params['grid_dims'], tuple):
+            params['grid_dims'] = list(params['grid_dims'])
+        yield params
+
+
+def compare(results, baseline, tolerance):
+    """returns a list of (params, metric, baseline_ms, current_ms) for every p50 slower than baseline * (1 + tolerance)"""
+    baseline_by_key = {case_key(r['params']): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        ref = baseline_by_key.get(case_key(r['params']))
+        if ref is None:
+            continue
+        for metric in ('update_ms', 'render_ms'):
+            if r[metric]['p50'] > ref[metric]['p50'] * (1 + tolerance):
+                regressions.append((r['params'], metric, ref[metric]['p50'], r[metric]['p50']))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless raycaster benchmark")
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--screen', type=int, nargs=2, default=(320, 240), metavar=('W', 'H'))
+    parser.add_argument('--sweep', help="JSON file overriding the default sweep, e.g. {\"n_rays\": [60, 640]}")
+    parser.add_argument('--out', help="where to write the results (JSON)")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed p50 slowdown vs. baseline")
+    parser.add_argument('--save-baseline', metavar='PATH', help="also write the results as a new baseline")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    for name in ('sweep', 'out', 'baseline', 'save_baseline'):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(INVOCATION_DIR, getattr(args, name)))
+    sweep = dict(DEFAULT_SWEEP)
+    if args.sweep:
+        with open(args.sweep) as f:
+            sweep.update(json.load(f))
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))  # needed by convert_alpha, invisible with the dummy driver
+    main.Art.load_from_disk()
+
+    results = {'frames': args.frames, 'seed': args.seed, 'screen': list(args.screen), 'results': []}
+    for params in iter_cases(sweep):
+        res = run_case(params, args.frames, args.seed, tuple(args.screen))
+        results['results'].append(res)
+        print("{}  update p50={:.2f}ms  render p50={:.2f}ms".format(
+            case_key(params), res['update_ms']['p50'], res['render_ms']['p50']))
+
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for params, metric, ref_ms, cur_ms in regressions:
+            print("REGRESSION {} {}: {:.2f}ms -> {:.2f}ms".format(case_key(params), metric, ref_ms, cur_ms))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,6 +1,22 @@
+import array
+import collections
+import json
 import math
+import os
 import random
+import struct
+import threading
+import time
+import weakref
 import katagames_sdk.engine as kataen
+try:
+    import numpy as np
+except ImportError:  # XXX numpy isn't available in web mode~
+    np = None
+try:
+    import mmap
+except ImportError:  # XXX no mmap in web mode~
+    mmap = None
 
 
 BaseGame = kataen.BaseGame
@@ -13,8 +29,22 @@ Vector2 = pygame.Vector2
 ############## art.py ##############
 
 class Art:
+    """
+        Sprites are cut from the atlas described by ATLAS_PATH: one sheet, the rect of every named frame,
+        and groups of frames (each group fills the Art list of the same name, e.g. ENEMIES).
+        The sheet is decoded once and frames are cut on first use, then cached in FRAMES.
+    """
     ENEMIES = [None] * 4
     PICKUPS = [None] * 5
+    MIPS = dict()  # id(image) -> [image, image at 1/2 size, image at 1/4 size, ...]
+    FRAMES = dict()  # frame name -> Surface
+    ATLAS_PATH = "assets/atlas.json"
+
+    _atlas = None
+    _sheet = None
+    _build_mips = False
+    _loader = None  # background thread decoding the sheet, see load_in_background
+    _loader_result = []
 
     @staticmethod
     def subsurface(surf, rect, colorkey=(0xFF, 0x00, 0xFF)):  # XXX Surface.subsurface not supported in web mode~
@@ -24,15 +54,254 @@ class Art:
         return res
 
     @staticmethod
-    def load_from_disk():
-        full_sheet = pygame.image.load("assets/art.png").convert_alpha()
-        for i in range(4):
-            Art.ENEMIES[i] = Art.subsurface(full_sheet, [i * 16, 0, 16, 32])
-        for i in range(5):
-            Art.PICKUPS[i] = Art.subsurface(full_sheet, [i * 16, 32, 16, 32])
+    def downsample(surf):
+        """half-size copy of a colorkeyed surface, averaging the opaque pixels of each 2x2 block"""
+        key = tuple(surf.get_colorkey()[:3])
+        w, h = surf.get_width() // 2, surf.get_height() // 2
+        px = pygame.surfarray.array3d(surf)[:w * 2, :h * 2].astype(np.int32).reshape(w, 2, h, 2, 3)
+        opaque = np.any(px != key, axis=4)
+        n_opaque = opaque.sum(axis=(1, 3))
+        sums = (px * opaque[..., None]).sum(axis=(1, 3))
+        avg = sums // np.maximum(n_opaque, 1)[..., None]
+        res = pygame.Surface((w, h))
+        pygame.surfarray.blit_array(res, np.where((n_opaque >= 2)[..., None], avg, key))
+        res.set_colorkey(key)
+        return res
+
+    @staticmethod
+    def build_mip_chain(img, min_height=4):
+        chain = [img]
+        while chain[-1].get_height() // 2 >= min_height and chain[-1].get_width() >= 2:
+            chain.append(Art.downsample(chain[-1]))
+        Art.MIPS[id(img)] = chain
+
+    @staticmethod
+    def get_atlas():
+        if Art._atlas is None:
+            with open(Art.ATLAS_PATH) as f:
+                Art._atlas = json.load(f)
+        return Art._atlas
+
+    @staticmethod
+    def _sheet_path():
+        return "{}/{}".format(Art.ATLAS_PATH.rsplit('/', 1)[0], Art.get_atlas()['image'])
+
+    @staticmethod
+    def get_sheet():
+        """the decoded and converted sheet, waiting for the background loader if there is one"""
+        if Art._sheet is None:
+            if Art._loader is not None:
+                Art._loader.join()
+                Art.poll()
+            else:
+                Art._sheet = pygame.image.load(Art._sheet_path()).convert_alpha()
+        return Art._sheet
+
+    @staticmethod
+    def _cut_frame(name, surf):
+        """(re)draws frame `name` of the sheet into surf, or into a new Surface if surf is None"""
+        rect = Art.get_atlas()['frames'][name]
+        colorkey = tuple(Art.get_atlas().get('colorkey', (0xFF, 0x00, 0xFF)))
+        if surf is None:
+            surf = Art.subsurface(Art.get_sheet(), rect, colorkey)
+        else:
+            surf.fill((0, 0, 0))
+            surf.blit(Art.get_sheet(), (0, 0), rect)
+        if Art._build_mips:  # XXX needs numpy/surfarray, not available in web mode~
+            Art.build_mip_chain(surf)
+        return surf
+
+    @staticmethod
+    def get_frame(name):
+        surf = Art.FRAMES.get(name)
+        if surf is None:
+            surf = Art.FRAMES[name] = Art._cut_frame(name, None)
+        return surf
+
+    @staticmethod
+    def _fill_groups(get_frame):
+        for group, names in Art.get_atlas()['groups'].items():
+            setattr(Art, group, [get_frame(name) for name in names])
+
+    @staticmethod
+    def load_from_disk(build_mips=False):
+        """fills the Art lists, the sheet is only decoded the first time"""
+        if build_mips != Art._build_mips:
+            Art._build_mips = build_mips
+            Art.FRAMES.clear()
+            Art.MIPS.clear()
+        Art._fill_groups(Art.get_frame)
+
+    @staticmethod
+    def load_in_background(build_mips=False):
+        """
+            fills the Art lists right away with blank (fully transparent) frames, and decodes the sheet in a thread.
+            poll() draws the actual sprites into these same Surfaces once it's done, so they can be used meanwhile
+        """
+        Art._build_mips = build_mips
+        if Art._sheet is not None:
+            Art.load_from_disk(build_mips)
+            return
+        atlas = Art.get_atlas()
+        colorkey = tuple(atlas.get('colorkey', (0xFF, 0x00, 0xFF)))
+        for name, rect in atlas['frames'].items():
+            if name not in Art.FRAMES:
+                blank = Art.FRAMES[name] = pygame.Surface((rect[2], rect[3]))
+                blank.fill(colorkey)
+                blank.set_colorkey(colorkey)
+        Art._fill_groups(Art.FRAMES.get)
+        if Art._loader is None:
+            Art._loader_result = []
+            Art._loader = threading.Thread(target=Art._load_sheet_job, args=(Art._sheet_path(), Art._loader_result),
+                                           daemon=True)
+            Art._loader.start()
+
+    @staticmethod
+    def _load_sheet_job(path, result):
+        result.append(pygame.image.load(path))
+
+    @staticmethod
+    def poll():
+        """
+            to call from the main thread (convert_alpha needs the display). Returns True when the background loader
+            just finished, meaning that every frame has been redrawn and scaled copies of them are stale
+        """
+        if Art._loader is None or Art._loader.is_alive():
+            return False
+        Art._loader = None
+        if not Art._loader_result:
+            raise RuntimeError("couldn't load {}".format(Art._sheet_path()))
+        Art._sheet = Art._loader_result.pop().convert_alpha()
+        Art.MIPS.clear()
+        for name, surf in Art.FRAMES.items():
+            Art._cut_frame(name, surf)
+        return True
+
+
+class SpriteCache:
+    """
+        LRU cache of scaled sprite images, keyed by (source image, quantized size).
+        The total amount of cached pixels is bounded by max_pixels, least recently used images get evicted first.
+        When the source has a mip chain (see Art.build_mip_chain) the smallest level that is still big enough
+        is scaled instead of the full-size image.
+    """
+
+    def __init__(self, max_pixels=1 << 20, size_step=2):
+        self.max_pixels = max_pixels
+        self.size_step = size_step
+        self._entries = collections.OrderedDict()  # (id(src), w, h) -> (src, scaled)
+        self._n_pixels = 0
+
+    def quantize(self, size):
+        step = self.size_step
+        h = max(step, int(round(size[1] / step)) * step)
+        w = max(1, int(round(size[0] * h / size[1]))) if size[1] > 0 else 1
+        return w, h
+
+    def get(self, image, size):
+        w, h = self.quantize(size)
+        key = (id(image), w, h)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is image:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        src = image
+        for level in Art.MIPS.get(id(image), ()):
+            if level.get_height() >= h:
+                src = level
+        scaled = pygame.transform.scale(src, (w, h))
+        scaled.set_colorkey(image.get_colorkey())
+
+        if entry is not None:
+            self._n_pixels -= entry[1].get_width() * entry[1].get_height()
+        self._entries[key] = (image, scaled)
+        self._n_pixels += w * h
+        while self._n_pixels > self.max_pixels and len(self._entries) > 1:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._n_pixels -= evicted.get_width() * evicted.get_height()
+        return scaled
+
+    def clear(self):
+        self._entries.clear()
+        self._n_pixels = 0
 
 ############## art.py ##############
 
+############## profiler.py ##############
+
+class FrameProfiler:
+    """
+        Times the phases of every frame (in ms) and keeps the last `window` frames of each phase,
+        to report rolling percentiles. Frames can also be streamed to a .csv or .jsonl file, one line per frame.
+    """
+    PHASES = ('input', 'player', 'enemies', 'rays', 'render')
+
+    def __init__(self, window=300, log_path=None):
+        self.samples = {name: collections.deque(maxlen=window) for name in self.PHASES + ('frame',)}
+        self.frame_idx = 0
+        self._current = dict()
+        self._starts = dict()
+        self._last_frame_end = None
+        self._log_file = None
+        self._log_csv = False
+        if log_path is not None:
+            self.open_log(log_path)
+
+    def open_log(self, path):
+        self.close()
+        self._log_file = open(path, 'w')
+        self._log_csv = path.endswith('.csv')
+        if self._log_csv:
+            self._log_file.write(",".join(('frame_idx',) + self.PHASES + ('frame',)) + "\n")
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def begin(self, phase):
+        self._starts[phase] = time.perf_counter()
+
+    def end(self, phase):
+        elapsed = (time.perf_counter() - self._starts.pop(phase)) * 1000
+        self._current[phase] = self._current.get(phase, 0.0) + elapsed
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self._last_frame_end is None:
+            frame_ms = sum(self._current.values())
+        else:
+            frame_ms = (now - self._last_frame_end) * 1000
+        self._last_frame_end = now
+
+        record = [self._current.get(name, 0.0) for name in self.PHASES] + [frame_ms]
+        for name, value in zip(self.PHASES + ('frame',), record):
+            self.samples[name].append(value)
+        if self._log_file is not None:
+            if self._log_csv:
+                self._log_file.write(",".join([str(self.frame_idx)] + ["{:.3f}".format(v) for v in record]) + "\n")
+            else:
+                row = dict(zip(self.PHASES + ('frame',), record))
+                row['frame_idx'] = self.frame_idx
+                self._log_file.write(json.dumps(row) + "\n")
+        self._current.clear()
+        self.frame_idx += 1
+
+    def percentiles(self, name, qs=(50, 95, 99)):
+        data = sorted(self.samples[name])
+        if len(data) == 0:
+            return [0.0] * len(qs)
+        return [data[min(len(data) - 1, int(q / 100 * len(data)))] for q in qs]
+
+    def get_report(self):
+        lines = ["{:<8} {:>6} {:>6} {:>6}".format("ms", "p50", "p95", "p99")]
+        for name in self.PHASES + ('frame',):
+            lines.append("{:<8} {:>6.2f} {:>6.2f} {:>6.2f}".format(name, *self.percentiles(name)))
+        return "\n".join(lines)
+
+############## profiler.py ##############
+
 ############## raycaster.py ##############
 
 class RayEmitter:
@@ -43,11 +312,32 @@ class RayEmitter:
         self.fov = fov
         self.n_rays = max(n_rays, 3)
         self.max_depth = max_depth
+        self._offsets_key = None
+        self._offsets = None  # [(cos, sin), ...] of the angle between each ray and self.direction
+        self._np_offsets = None
+
+    def get_ray_offsets(self):
+        """rebuilt only when fov or n_rays change"""
+        key = (self.fov[0], self.n_rays)
+        if key != self._offsets_key:
+            step = self.fov[0] / self.n_rays
+            angles = [math.radians((i + 0.5) * step - self.fov[0] / 2) for i in range(self.n_rays)]
+            self._offsets = [(math.cos(a), math.sin(a)) for a in angles]
+            self._np_offsets = np.array(self._offsets, dtype=np.float64).reshape(-1, 2) if np is not None else None
+            self._offsets_key = key
+        return self._offsets
 
     def get_rays(self):
-        left_ray = self.direction.rotate(-self.fov[0] / 2)
-        for i in range(self.n_rays):
-            yield left_ray.rotate((i + 0.5) * self.fov[0] / self.n_rays)
+        dx, dy = self.direction
+        for c, s in self.get_ray_offsets():
+            yield Vector2(dx * c - dy * s, dx * s + dy * c)
+
+    def get_ray_arrays(self):
+        """same rays as get_rays, as two numpy arrays (rays_x, rays_y)"""
+        self.get_ray_offsets()
+        dx, dy = self.direction
+        c, s = self._np_offsets[:, 0], self._np_offsets[:, 1]
+        return dx * c - dy * s, dx * s + dy * c
 
 
 class Player(RayEmitter):
@@ -77,6 +367,12 @@ class Player(RayEmitter):
     def turn(self, direction, dt):
         self.direction.rotate_ip(direction * self.turn_speed * dt)
 
+    def get_pose(self):
+        return Vector2(self.xy), Vector2(self.direction), self.z
+
+    def set_pose(self, pose):
+        self.xy, self.direction, self.z = Vector2(pose[0]), Vector2(pose[1]), pose[2]
+
     def jump(self):
         if self.z == 0 and self._z_vel == 0:
             self._z_vel = 8
@@ -91,13 +387,21 @@ class Player(RayEmitter):
 
 
 class GameWorld:
+    has_index_grid = True  # whether get_index_grid is supported, which the numpy casters rely on
 
     def __init__(self, grid_dims, cell_size, bg_color=(0, 0, 0)):
+        self.cell_size = cell_size
+        self.bg_color = bg_color
+        self.revision = 0  # bumped on every set_cell, lets caches know they're stale
+        self.distance_field = None
+        self.cell_listeners = []  # callables taking (xy, color), called by set_cell
+        self._change_log = collections.deque(maxlen=4096)  # coords of the latest set_cell calls
+        self._init_cells(grid_dims)
+
+    def _init_cells(self, grid_dims):
         self.grid = []
         for _ in range(grid_dims[0]):
             self.grid.append([None] * grid_dims[1])
-        self.cell_size = cell_size
-        self.bg_color = bg_color
 
     def randomize(self, chance=0.2, n_colors=5):
         colors = []
@@ -124,9 +428,16 @@ class GameWorld:
     def set_cell(self, xy, color):
         if self.is_valid(xy):
             self.grid[xy[0]][xy[1]] = color
+            self.revision += 1
+            self._change_log.append((xy[0], xy[1]))
+            if self.distance_field is not None:
+                self.distance_field.mark_dirty(xy)
+            for listener in self.cell_listeners:
+                listener(xy, color)
 
     def is_valid(self, xy):
-        return 0 <= xy[0] < self.get_dims()[0] and 0 <= xy[1] < self.get_dims()[1]
+        dims = self.get_dims()
+        return 0 <= xy[0] < dims[0] and 0 <= xy[1] < dims[1]
 
     def get_cell(self, xy):
         if self.is_valid(xy):
@@ -161,6 +472,35 @@ class GameWorld:
         dims = self.get_dims()
         return (dims[0] * self.cell_size, dims[1] * self.cell_size)
 
+    def get_changes_since(self, revision):
+        """coords of the cells set since `revision`, or None when there were too many changes to list them"""
+        n = self.revision - revision
+        if n > len(self._change_log):
+            return None
+        return [self._change_log[i] for i in range(len(self._change_log) - n, len(self._change_log))]
+
+    def enable_distance_field(self, max_dist=8):
+        self.distance_field = DistanceField(self, max_dist)
+        return self.distance_field
+
+    def get_index_grid(self):
+        """
+            returns (index_grid, palette) where index_grid is a numpy array of shape get_dims(),
+            holding 0 for empty cells and k for cells of color palette[k - 1]
+        """
+        palette = []
+        color_to_idx = {None: 0}
+        rows = []
+        for column in self.grid:
+            row = []
+            for color in column:
+                if color not in color_to_idx:
+                    palette.append(color)
+                    color_to_idx[color] = len(palette)
+                row.append(color_to_idx[color])
+            rows.append(row)
+        return np.array(rows, dtype=np.uint16).reshape(self.get_dims()), palette
+
     def get_width(self):
         return self.get_size()[0]
 
@@ -168,6 +508,309 @@ class GameWorld:
         return self.get_size()[1]
 
 
+class CompactGameWorld(GameWorld):
+    """
+        Same API as GameWorld, but cells are stored as palette indices in a flat bytearray
+        (cell (x, y) at x * H + y, index 0 meaning empty) and each color is stored once in self.palette.
+        Dimensions are cached, so get_cell is a bounds check plus two lookups.
+    """
+
+    def _init_cells(self, grid_dims):
+        self._dims = (grid_dims[0], grid_dims[1])
+        self.cells = bytearray(grid_dims[0] * grid_dims[1])
+        self.palette = [None]
+        self._color_to_idx = {None: 0}
+
+    @classmethod
+    def from_buffer(cls, cells, grid_dims, cell_size, palette, bg_color=(0, 0, 0)):
+        """
+            wraps existing palette indices without copying them. cells can be any writable buffer of 1 or 2 byte
+            items laid out like self.cells (e.g. a memoryview over a memory-mapped file), palette excludes index 0
+        """
+        world = cls((0, 0), cell_size, bg_color)
+        world._dims = (grid_dims[0], grid_dims[1])
+        world.cells = cells
+        world.palette = [None] + [tuple(color) for color in palette]
+        world._color_to_idx = {color: i for i, color in enumerate(world.palette)}
+        return world
+
+    def _get_color_idx(self, color):
+        if color is not None:
+            color = tuple(color)
+        idx = self._color_to_idx.get(color)
+        if idx is None:
+            idx = len(self.palette)
+            if idx == 256 and getattr(self.cells, 'itemsize', 1) == 1:
+                self.cells = array.array('H', list(self.cells))  # too many colors for one byte per cell
+            elif idx == 65536:
+                raise ValueError("too many distinct colors in CompactGameWorld")
+            self.palette.append(color)
+            self._color_to_idx[color] = idx
+        return idx
+
+    def set_cell(self, xy, color):
+        x, y = xy
+        w, h = self._dims
+        if 0 <= x < w and 0 <= y < h:
+            self.cells[x * h + y] = self._get_color_idx(color)
+            self.revision += 1
+            self._change_log.append((xy[0], xy[1]))
+            if self.distance_field is not None:
+                self.distance_field.mark_dirty(xy)
+            for listener in self.cell_listeners:
+                listener(xy, color)
+
+    def is_valid(self, xy):
+        return 0 <= xy[0] < self._dims[0] and 0 <= xy[1] < self._dims[1]
+
+    def get_cell(self, xy):
+        x, y = xy
+        w, h = self._dims
+        if 0 <= x < w and 0 <= y < h:
+            return self.palette[self.cells[x * h + y]]
+        return None
+
+    def get_cell_value_at(self, x, y):
+        cs = self.cell_size
+        return self.get_cell((int(x / cs), int(y / cs)))
+
+    def get_dims(self):
+        return self._dims
+
+    def get_index_grid(self):
+        dtype = np.uint8 if getattr(self.cells, 'itemsize', 1) == 1 else np.uint16
+        return np.frombuffer(self.cells, dtype=dtype).reshape(self._dims), self.palette[1:]
+
+
+class ChunkedGameWorld(GameWorld):
+    """
+        GameWorld split in chunk_size x chunk_size chunks of palette indices, each one generated from `seed`
+        the first time one of its cells is read. At most max_chunks generated chunks are kept in memory
+        (max_chunks * chunk_size ** 2 bytes), least recently used ones being evicted and regenerated when needed.
+        Chunks modified through set_cell are kept for good. grid_dims only bounds the valid coordinates,
+        nothing is allocated up front, so it can be huge.
+    """
+    has_index_grid = False
+
+    def __init__(self, grid_dims, cell_size, seed=0, chunk_size=32, max_chunks=256, chance=0.2, n_colors=5,
+                 bg_color=(0, 0, 0)):
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chance = chance
+        self.n_colors = n_colors
+        super().__init__(grid_dims, cell_size, bg_color)
+
+    def _init_cells(self, grid_dims):
+        self._dims = (grid_dims[0], grid_dims[1])
+        self._chunks = collections.OrderedDict()  # (cx, cy) -> bytearray, in LRU order
+        self._edited_chunks = dict()
+        rng = random.Random(self.seed)
+        self.palette = [None]
+        for _ in range(self.n_colors):
+            self.palette.append((rng.randint(50, 255), rng.randint(50, 255), rng.randint(50, 255)))
+        self._color_to_idx = {color: i for i, color in enumerate(self.palette)}
+
+    def randomize(self, chance=None, n_colors=None):
+        """picks a new seed, the chunks will be generated from it. chance and n_colors are kept unless given"""
+        self.seed = random.getrandbits(32)
+        if chance is not None:
+            self.chance = chance
+        if n_colors is not None:
+            self.n_colors = n_colors
+        self._init_cells(self._dims)
+        self.revision += 1
+        self._change_log.clear()  # every cell may have changed, get_changes_since has to report a full reset
+        return self
+
+    def _generate_chunk(self, cx, cy):
+        size = self.chunk_size
+        rng = random.Random((self.seed * 73856093) ^ (cx * 19349663) ^ (cy * 83492791))
+        n_colors = self.n_colors  # not len(self.palette): set_cell adds colors, regenerated chunks mustn't change
+        w, h = self._dims
+        cells = bytearray(size * size)
+        for i in range(size):
+            x = cx * size + i
+            for j in range(size):
+                y = cy * size + j
+                if x == 0 or y == 0 or x == w - 1 or y == h - 1:
+                    cells[i * size + j] = 1  # border
+                elif rng.random() < self.chance:
+                    cells[i * size + j] = rng.randint(1, n_colors)
+        return cells
+
+    def _get_chunk(self, chunk_xy):
+        chunk = self._edited_chunks.get(chunk_xy)
+        if chunk is not None:
+            return chunk
+        chunk = self._chunks.get(chunk_xy)
+        if chunk is not None:
+            self._chunks.move_to_end(chunk_xy)
+            return chunk
+        chunk = self._chunks[chunk_xy] = self._generate_chunk(chunk_xy[0], chunk_xy[1])
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def preload_around(self, xy, radius):
+        """generates the chunks within `radius` (in world units) of xy ahead of time"""
+        span = self.chunk_size * self.cell_size
+        for cx in range(int((xy[0] - radius) // span), int((xy[0] + radius) // span) + 1):
+            for cy in range(int((xy[1] - radius) // span), int((xy[1] + radius) // span) + 1):
+                self._get_chunk((cx, cy))
+
+    def set_cell(self, xy, color):
+        x, y = xy
+        if 0 <= x < self._dims[0] and 0 <= y < self._dims[1]:
+            if color is not None:
+                color = tuple(color)
+            idx = self._color_to_idx.get(color)
+            if idx is None:
+                if len(self.palette) == 256:
+                    raise ValueError("too many distinct colors in ChunkedGameWorld")
+                idx = self._color_to_idx[color] = len(self.palette)
+                self.palette.append(color)
+            size = self.chunk_size
+            chunk_xy = (x // size, y // size)
+            chunk = self._get_chunk(chunk_xy)
+            if chunk_xy not in self._edited_chunks:
+                self._chunks.pop(chunk_xy, None)
+                self._edited_chunks[chunk_xy] = chunk
+            chunk[(x % size) * size + y % size] = idx
+            self.revision += 1
+            self._change_log.append((x, y))
+            for listener in self.cell_listeners:
+                listener(xy, color)
+
+    def is_valid(self, xy):
+        return 0 <= xy[0] < self._dims[0] and 0 <= xy[1] < self._dims[1]
+
+    def get_cell(self, xy):
+        x, y = xy
+        if 0 <= x < self._dims[0] and 0 <= y < self._dims[1]:
+            size = self.chunk_size
+            return self.palette[self._get_chunk((x // size, y // size))[(x % size) * size + y % size]]
+        return None
+
+    def get_dims(self):
+        return self._dims
+
+    def enable_distance_field(self, max_dist=8):
+        raise ValueError("{} has no dense grid to build a distance field on".format(type(self).__name__))
+
+    def get_index_grid(self):
+        raise ValueError("{} has no dense grid".format(type(self).__name__))
+
+
+class DistanceField:
+    """
+        Chebyshev distance (in cells) from every cell of a GameWorld to its nearest wall, capped at max_dist.
+        Walls are at 0, and a cell at distance d guarantees that no wall exists within d - 1 cells of it.
+        Cells changed through GameWorld.set_cell are patched lazily, on the next query.
+    """
+
+    def __init__(self, world: GameWorld, max_dist=8):
+        self.world = world
+        self.max_dist = max(1, min(max_dist, 255))
+        self._dims = world.get_dims()
+        self.values = bytearray(self._dims[0] * self._dims[1])
+        self._pending = set()
+        self._needs_rebuild = True
+        self._np_view = None
+
+    def mark_dirty(self, xy):
+        if not self._needs_rebuild:
+            self._pending.add((xy[0], xy[1]))
+            patch_area = (4 * self.max_dist + 1) ** 2
+            if len(self._pending) * patch_area > len(self.values):
+                self._needs_rebuild = True  # cheaper to start over
+                self._pending.clear()
+
+    def refresh(self):
+        if self._needs_rebuild:
+            self._update_rect(0, 0, self._dims[0], self._dims[1], 0)
+            self._needs_rebuild = False
+        elif self._pending:
+            r = self.max_dist
+            for x, y in self._pending:
+                # only cells within r of the change can be affected, and they only depend on walls within 2r
+                self._update_rect(x - 2 * r, y - 2 * r, x + 2 * r + 1, y + 2 * r + 1, r)
+            self._pending.clear()
+
+    def _update_rect(self, x0, y0, x1, y1, margin):
+        """recomputes the field over [x0, x1) x [y0, y1) but only writes it back `margin` cells inside the rect"""
+        world_w, world_h = self._dims
+        wx0, wy0 = max(x0 + margin, 0), max(y0 + margin, 0)
+        wx1, wy1 = min(x1 - margin, world_w), min(y1 - margin, world_h)
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, world_w), min(y1, world_h)
+        w, h = x1 - x0, y1 - y0
+        if w <= 0 or h <= 0:
+            return
+        cap = self.max_dist
+        get_cell = self.world.get_cell
+        d = [0 if get_cell((x, y)) is not None else cap for x in range(x0, x1) for y in range(y0, y1)]
+
+        # two-pass chamfer with unit weights on all 8 neighbours, which is exact for Chebyshev distances
+        for i in range(w):
+            for j in range(h):
+                k = i * h + j
+                v = d[k]
+                if v == 0:
+                    continue
+                if j > 0 and d[k - 1] + 1 < v:
+                    v = d[k - 1] + 1
+                if i > 0:
+                    for nk in range(k - h - (j > 0), k - h + (j < h - 1) + 1):
+                        if d[nk] + 1 < v:
+                            v = d[nk] + 1
+                d[k] = v
+        for i in range(w - 1, -1, -1):
+            for j in range(h - 1, -1, -1):
+                k = i * h + j
+                v = d[k]
+                if v == 0:
+                    continue
+                if j < h - 1 and d[k + 1] + 1 < v:
+                    v = d[k + 1] + 1
+                if i < w - 1:
+                    for nk in range(k + h - (j > 0), k + h + (j < h - 1) + 1):
+                        if d[nk] + 1 < v:
+                            v = d[nk] + 1
+                d[k] = v
+
+        for x in range(wx0, wx1):
+            k = (x - x0) * h - y0
+            for y in range(wy0, wy1):
+                self.values[x * world_h + y] = d[k + y]
+
+    def load_values(self, values):
+        """adopts precomputed values (e.g. read from a map file) instead of rebuilding the field"""
+        self.values = values
+        self._needs_rebuild = False
+        self._pending.clear()
+        self._np_view = None
+
+    def get(self, cell_xy):
+        if self._needs_rebuild or self._pending:
+            self.refresh()
+        x, y = cell_xy
+        if 0 <= x < self._dims[0] and 0 <= y < self._dims[1]:
+            return self.values[x * self._dims[1] + y]
+        return 0
+
+    def get_at(self, x, y):
+        cs = self.world.cell_size
+        return self.get((int(x / cs), int(y / cs)))
+
+    def get_grid(self):
+        """numpy view of the field, with the same shape as GameWorld.get_index_grid()"""
+        self.refresh()
+        if self._np_view is None:
+            self._np_view = np.frombuffer(self.values, dtype=np.uint8).reshape(self._dims)
+        return self._np_view
+
+
 class RayState:
     """The state of a single ray."""
     def __init__(self, idx, start, end, ray, color):
@@ -187,7 +830,484 @@ class RayState:
         return "RayState(start={}, end={}, color={})".format(self.start, self.end, self.color)
 
 
+def cast_rays_batch(index_grid, cell_size, start_xy, rays_x, rays_y, max_dist, skip_grid=None):
+    """
+        Same walk as GameState.cast_ray, but for a whole fan of rays at once.
+        max_dist can be a scalar or an array (one value per ray), skip_grid is an optional DistanceField grid.
+        returns (dists, hits_x, hits_y, color_idx) arrays, color_idx being 0 where nothing was hit
+    """
+    n = len(rays_x)
+    start_x, start_y = float(start_xy[0]), float(start_xy[1])
+    dists = np.full(n, np.inf)
+    hits_x = np.full(n, np.nan)
+    hits_y = np.full(n, np.nan)
+    color_idx = np.zeros(n, dtype=index_grid.dtype)
+
+    dir_sign_x = np.where(rays_x > 0, 1, -1)
+    dir_sign_y = np.where(rays_y > 0, 1, -1)
+    tile_offset_x = (rays_x > 0).astype(np.int64)
+    tile_offset_y = (rays_y > 0).astype(np.int64)
+
+    tile_x = np.full(n, int(start_x / cell_size), dtype=np.int64)
+    tile_y = np.full(n, int(start_y / cell_size), dtype=np.int64)
+    cur_x = np.full(n, start_x)
+    cur_y = np.full(n, start_y)
+    t = np.zeros(n)
+
+    max_x = start_x + rays_x * max_dist
+    max_y = start_y + rays_y * max_dist
+    rays_len = np.sqrt(rays_x * rays_x + rays_y * rays_y)
+    grid_w, grid_h = index_grid.shape
+
+    live = np.flatnonzero((rays_x != 0) | (rays_y != 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while live.size > 0:
+            rx, ry = rays_x[live], rays_y[live]
+            cx, cy = cur_x[live], cur_y[live]
+            in_range = (np.where(rx >= 0, cx <= max_x[live], cx >= max_x[live])
+                        & np.where(ry >= 0, cy <= max_y[live], cy >= max_y[live]))
+            if not in_range.all():
+                live, rx, ry, cx, cy = live[in_range], rx[in_range], ry[in_range], cx[in_range], cy[in_range]
+
+            tx, ty = tile_x[live], tile_y[live]
+            valid = (tx >= 0) & (tx < grid_w) & (ty >= 0) & (ty < grid_h)
+            cells = np.zeros(live.size, dtype=index_grid.dtype)
+            cells[valid] = index_grid[tx[valid], ty[valid]]
+            hit = cells != 0
+            if hit.any():
+                hit_idx = live[hit]
+                hits_x[hit_idx] = cx[hit]
+                hits_y[hit_idx] = cy[hit]
+                dists[hit_idx] = np.hypot(cx[hit] - start_x, cy[hit] - start_y)
+                color_idx[hit_idx] = cells[hit]
+                miss = ~hit
+                live, rx, ry, cx, cy, tx, ty = live[miss], rx[miss], ry[miss], cx[miss], cy[miss], tx[miss], ty[miss]
+                valid = valid[miss]
+
+            stepping = live
+            if skip_grid is not None:
+                skips = np.zeros(live.size, dtype=np.int64)
+                skips[valid] = skip_grid[tx[valid], ty[valid]]
+                jump = skips > 1
+                if jump.any():
+                    jump_idx = live[jump]
+                    t[jump_idx] += (skips[jump] - 1) * cell_size / rays_len[jump_idx]
+                    cur_x[jump_idx] = start_x + rx[jump] * t[jump_idx]
+                    cur_y[jump_idx] = start_y + ry[jump] * t[jump_idx]
+                    tile_x[jump_idx] = (cur_x[jump_idx] / cell_size).astype(np.int64)
+                    tile_y[jump_idx] = (cur_y[jump_idx] / cell_size).astype(np.int64)
+                    step = ~jump
+                    stepping, rx, ry, cx, cy, tx, ty = live[step], rx[step], ry[step], cx[step], cy[step], tx[step], ty[step]
+
+            dt_x = np.where(rx == 0, np.inf, ((tx + tile_offset_x[stepping]) * cell_size - cx) / rx)
+            dt_y = np.where(ry == 0, np.inf, ((ty + tile_offset_y[stepping]) * cell_size - cy) / ry)
+            step_x = dt_x < dt_y
+            t[stepping] += np.where(step_x, dt_x, dt_y)
+            tile_x[stepping] = tx + np.where(step_x, dir_sign_x[stepping], 0)
+            tile_y[stepping] = ty + np.where(step_x, 0, dir_sign_y[stepping])
+            cur_x[stepping] = start_x + rx * t[stepping]
+            cur_y[stepping] = start_y + ry * t[stepping]
+
+    return dists, hits_x, hits_y, color_idx
+
+
+class BatchRayCaster:
+    """Casts all the rays of an emitter at once, over a numpy copy of the GameWorld grid."""
+
+    def __init__(self, world: GameWorld):
+        self.world = world
+        self._index_grid = None
+        self._palette = None
+        self._revision = None
+
+    def _sync(self):
+        if self._revision != self.world.revision:
+            self._index_grid, self._palette = self.world.get_index_grid()
+            self._revision = self.world.revision
+
+    def get_palette(self):
+        self._sync()
+        return self._palette
+
+    def cast(self, start_xy, rays_x, rays_y, max_dist):
+        self._sync()
+        dist_field = self.world.distance_field
+        skip_grid = dist_field.get_grid() if dist_field is not None else None
+        return cast_rays_batch(self._index_grid, self.world.cell_size, start_xy, rays_x, rays_y, max_dist, skip_grid)
+
+    def cast_ray_states(self, emitter: RayEmitter):
+        """returns the same list of RayState objects as calling GameState.cast_ray once per ray"""
+        rays = list(emitter.get_rays())
+        rays_x, rays_y = emitter.get_ray_arrays()
+        _, hits_x, hits_y, color_idx = self.cast(emitter.xy, rays_x, rays_y, emitter.max_depth)
+        palette = self._palette
+        res = []
+        for i, ray in enumerate(rays):
+            k = color_idx[i]
+            if k == 0:
+                res.append(RayState(i, emitter.xy, None, ray, None))
+            else:
+                res.append(RayState(i, emitter.xy, Vector2(hits_x[i], hits_y[i]), ray, palette[k - 1]))
+        return res
+
+
+_worker_shm = None
+_worker_grid = None
+
+
+def _init_cast_worker(shm_name, shape, dtype_str):
+    from multiprocessing import shared_memory
+    global _worker_shm, _worker_grid
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_grid = np.ndarray(shape, dtype=np.dtype(dtype_str), buffer=_worker_shm.buf)
+
+
+def _cast_chunk(args):
+    cell_size, start_xy, rays_x, rays_y, max_dist = args
+    dists, _, _, color_idx = cast_rays_batch(_worker_grid, cell_size, start_xy, rays_x, rays_y, max_dist)
+    return dists, color_idx
+
+
+def _release_cast_pool(pool, shm):
+    # casts are synchronous so the workers are idle: let them exit, as terminate() may hang on workers
+    # that inherited the SDL signal handlers
+    pool.close()
+    pool.join()
+    try:
+        shm.close()
+    except BufferError:  # a view of the grid is still alive, the mapping goes away with it
+        pass
+    shm.unlink()
+
+
+class ParallelRayCaster:
+    """
+        Splits ray fans across a pool of worker processes. The palette-index grid of the GameWorld is copied once
+        into a multiprocessing.shared_memory block, then kept current by writing there the cells changed
+        through set_cell. Workers send back only per-ray distances and color indices.
+    """
+
+    def __init__(self, world: GameWorld, n_workers=None):
+        if not world.has_index_grid:
+            raise ValueError("{} has no dense grid to share with the workers".format(type(world).__name__))
+        # XXX multiprocessing isn't available in web mode~
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        self.world = world
+        index_grid, palette = world.get_index_grid()
+        self._palette = list(palette)
+        self._color_to_idx = {color: i + 1 for i, color in enumerate(self._palette)}
+        self._color_to_idx[None] = 0
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, index_grid.size * 2))
+        self._grid = np.ndarray(index_grid.shape, dtype=np.uint16, buffer=self._shm.buf)
+        self._grid[:] = index_grid
+        world.cell_listeners.append(self._on_cell_changed)
+
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self.n_workers, initializer=_init_cast_worker,
+                                          initargs=(self._shm.name, self._grid.shape, self._grid.dtype.str))
+        # the workers and the shared block are released by close(), or when the caster is garbage collected
+        self._finalizer = weakref.finalize(self, _release_cast_pool, self._pool, self._shm)
+
+    def _on_cell_changed(self, xy, color):
+        if color is not None:
+            color = tuple(color)
+        idx = self._color_to_idx.get(color)
+        if idx is None:
+            self._palette.append(color)
+            idx = self._color_to_idx[color] = len(self._palette)
+        self._grid[xy[0], xy[1]] = idx
+
+    def cast(self, start_xy, rays_x, rays_y, max_dist):
+        """returns (dists, color_idx) arrays, color_idx being 0 where nothing was hit"""
+        n_chunks = max(1, min(self.n_workers, len(rays_x) // 32))
+        start_xy = (float(start_xy[0]), float(start_xy[1]))
+        jobs = [(self.world.cell_size, start_xy, xs, ys, max_dist)
+                for xs, ys in zip(np.array_split(rays_x, n_chunks), np.array_split(rays_y, n_chunks))]
+        results = self._pool.map(_cast_chunk, jobs)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def cast_ray_states(self, emitter: RayEmitter):
+        rays = list(emitter.get_rays())
+        rays_x, rays_y = emitter.get_ray_arrays()
+        dists, color_idx = self.cast(emitter.xy, rays_x, rays_y, emitter.max_depth)
+        res = []
+        for i, ray in enumerate(rays):
+            k = color_idx[i]
+            if k == 0:
+                res.append(RayState(i, emitter.xy, None, ray, None))
+            else:
+                res.append(RayState(i, emitter.xy, emitter.xy + ray * dists[i], ray, self._palette[k - 1]))
+        return res
+
+    def close(self):
+        if self._pool is not None:
+            self._pool = None
+            self.world.cell_listeners.remove(self._on_cell_changed)
+            self._grid = None
+            self._finalizer()
+
+
+class VisibilityIndex:
+    """
+        Caches line of sight results between pairs of cells, the cache being dropped whenever the GameWorld changes.
+        LOS is computed from the center of the end cell to the center of the start cell, so that batched queries
+        against a common target (e.g. all enemies vs. the player) share a single start point.
+    """
+
+    def __init__(self, state: 'GameState', max_entries=100000):
+        self.state = state
+        self.max_entries = max_entries
+        self._cache = dict()
+        self._revision = None
+
+    def _validate(self):
+        if self._revision != self.state.world.revision or len(self._cache) > self.max_entries:
+            self._cache.clear()
+            self._revision = self.state.world.revision
+
+    def _cell_center(self, cell_xy):
+        cs = self.state.world.cell_size
+        return Vector2((cell_xy[0] + 0.5) * cs, (cell_xy[1] + 0.5) * cs)
+
+    def has_line_of_sight(self, start_xy, end_xy):
+        self._validate()
+        world = self.state.world
+        key = (world.get_cell_coords_at(start_xy[0], start_xy[1]), world.get_cell_coords_at(end_xy[0], end_xy[1]))
+        res = self._cache.get(key)
+        if res is None:
+            if key[0] == key[1]:
+                res = True
+            else:
+                res = self.state.has_line_of_sight(self._cell_center(key[1]), self._cell_center(key[0]))
+            self._cache[key] = res
+        return res
+
+    def batch_line_of_sight(self, sources, target_xy):
+        """returns one LOS result per position in sources, casting all the cache misses at once"""
+        self._validate()
+        world = self.state.world
+        target_cell = world.get_cell_coords_at(target_xy[0], target_xy[1])
+        keys = [(world.get_cell_coords_at(xy[0], xy[1]), target_cell) for xy in sources]
+        missing = list({k for k in keys if k not in self._cache})
+        if len(missing) > 1 and self.state.batch_caster is not None:
+            target_center = self._cell_center(target_cell)
+            cs = world.cell_size
+            deltas = np.array([k[0] for k in missing], dtype=np.float64) * cs + 0.5 * cs - (target_center[0], target_center[1])
+            dists = np.hypot(deltas[:, 0], deltas[:, 1])
+            nonzero_dists = np.where(dists > 0, dists, 1)
+            _, _, _, color_idx = self.state.batch_caster.cast(target_center, deltas[:, 0] / nonzero_dists,
+                                                              deltas[:, 1] / nonzero_dists, dists)
+            for k, c in zip(missing, color_idx):
+                self._cache[k] = bool(c == 0)
+        cache = self._cache
+        return [cache[k] if k in cache else self.has_line_of_sight(xy, target_xy) for k, xy in zip(keys, sources)]
+
+
+class AIScheduler:
+    """
+        Updates the entities of a GameState, enemies far from the player less often than close ones:
+        lod_levels is a list of (max distance, period in ticks), an enemy being updated every `period` ticks
+        with the time accumulated since its last update. Updates are staggered so that they don't all fall
+        on the same tick. Enemies' line of sight checks are queued and processed by batches, for at most
+        los_budget_ms per tick, enemies acting on their latest result meanwhile. Moves are resolved against
+        the walls all at once.
+    """
+
+    def __init__(self, state: 'GameState', lod_levels=((300, 1), (800, 4), (float('inf'), 16)), los_budget_ms=1.0,
+                 los_batch_size=64):
+        self.state = state
+        self.lod_levels = lod_levels
+        self.los_budget_ms = los_budget_ms
+        self.los_batch_size = los_batch_size
+        self.sees_player = dict()  # enemy -> latest LOS result
+        self._tick = 0
+        self._slots = dict()  # enemy -> [stagger offset, time since its last update]
+        self._los_queue = collections.deque()
+        self._queued = set()
+
+    def get_period(self, dist):
+        for max_dist, period in self.lod_levels:
+            if dist < max_dist:
+                return period
+        return self.lod_levels[-1][1]
+
+    def forget(self, entity):
+        self._slots.pop(entity, None)
+        self.sees_player.pop(entity, None)
+
+    def update(self, dt):
+        state = self.state
+        player_xy = state.player.xy
+        game_over = state.is_game_over()
+        self._tick += 1
+
+        due = []
+        for ent in list(state.entities):
+            if not isinstance(ent, Enemy):
+                ent.update(state, dt)
+                continue
+            slot = self._slots.get(ent)
+            if slot is None:
+                slot = self._slots[ent] = [len(self._slots), 0.0]
+            slot[1] += dt
+            dist = ent.xy.distance_to(player_xy)
+            if (self._tick + slot[0]) % self.get_period(dist) == 0:
+                due.append((ent, slot[1]))
+                slot[1] = 0.0
+                if not game_over and dist < ent.sight_radius and ent not in self._queued:
+                    self._queued.add(ent)
+                    self._los_queue.append(ent)
+
+        self._process_los_queue(player_xy)
+
+        new_positions = []
+        for ent, ent_dt in due:
+            sees_player = ent.xy.distance_to(player_xy) < ent.sight_radius and self.sees_player.get(ent, False)
+            new_positions.append(ent.think(state, ent_dt, sees_player))
+        resolved = state.get_closest_unobstructed_positions(new_positions)
+        for (ent, ent_dt), new_pos, unwalled_new_pos in zip(due, new_positions, resolved):
+            ent.finish_move(state, new_pos, unwalled_new_pos, ent_dt)
+
+    def _process_los_queue(self, player_xy):
+        deadline = time.perf_counter() + self.los_budget_ms / 1000
+        queue = self._los_queue
+        while queue:  # at least one batch per tick, so that the queue always drains
+            batch = [queue.popleft() for _ in range(min(self.los_batch_size, len(queue)))]
+            results = self.state.visibility.batch_line_of_sight([ent.xy for ent in batch], player_xy)
+            for ent, res in zip(batch, results):
+                self.sees_player[ent] = res
+                self._queued.discard(ent)
+            if time.perf_counter() >= deadline:
+                break
+
+
+class FlowField:
+    """
+        Breadth first search over the empty cells of the world, from the player's cell up to max_radius cells away
+        (8-connected, without cutting corners). next_step maps every reached cell to the neighbouring cell to go to
+        in order to get closer to the player. Recomputed on demand, when the player changed cell or the world changed.
+    """
+    NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+    def __init__(self, state: 'GameState', max_radius=24):
+        self.state = state
+        self.max_radius = max_radius
+        self.dist = dict()  # cell -> number of steps to the player's cell
+        self.next_step = dict()
+        self._key = None
+
+    def refresh(self):
+        world = self.state.world
+        player_xy = self.state.player.xy
+        origin = world.get_cell_coords_at(player_xy[0], player_xy[1])
+        key = (origin, world.revision)
+        if key == self._key:
+            return
+        self._key = key
+
+        get_cell, is_valid = world.get_cell, world.is_valid
+        dist = self.dist = {origin: 0}
+        next_step = self.next_step = {origin: origin}
+        frontier = [origin]
+        for d in range(1, self.max_radius + 1):
+            new_frontier = []
+            for cell in frontier:
+                x, y = cell
+                for dx, dy in self.NEIGHBOURS:
+                    n = (x + dx, y + dy)
+                    if n in dist or get_cell(n) is not None or not is_valid(n):
+                        continue
+                    if dx != 0 and dy != 0 and (get_cell((x + dx, y)) is not None or get_cell((x, y + dy)) is not None):
+                        continue
+                    dist[n] = d
+                    next_step[n] = cell
+                    new_frontier.append(n)
+            frontier = new_frontier
+            if not frontier:
+                break
+
+    def get_direction(self, xy):
+        """unit vector from xy toward the center of the next cell on the way to the player, None if there's none"""
+        self.refresh()
+        world = self.state.world
+        cell = world.get_cell_coords_at(xy[0], xy[1])
+        nxt = self.next_step.get(cell)
+        if nxt is None or nxt == cell:
+            return None
+        cs = world.cell_size
+        res = Vector2((nxt[0] + 0.5) * cs - xy[0], (nxt[1] + 0.5) * cs - xy[1])
+        if res.length_squared() == 0:
+            return None
+        res.scale_to_length(1)
+        return res
+
+
+class SpatialHash:
+    """Uniform grid of square buckets, each one mapping to the entities whose xy lies inside it."""
+
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self.max_radius = 0  # largest Entity.radius ever inserted
+        self._buckets = dict()  # (bx, by) -> {entity: None}, used as an ordered set
+        self._entity_bucket = dict()
+
+    def _bucket_of(self, xy):
+        return int(xy[0] // self.bucket_size), int(xy[1] // self.bucket_size)
+
+    def insert(self, entity):
+        bucket = self._bucket_of(entity.xy)
+        self._buckets.setdefault(bucket, dict())[entity] = None
+        self._entity_bucket[entity] = bucket
+        self.max_radius = max(self.max_radius, entity.radius)
+
+    def remove(self, entity):
+        bucket = self._entity_bucket.pop(entity)
+        content = self._buckets[bucket]
+        del content[entity]
+        if not content:
+            del self._buckets[bucket]
+
+    def update(self, entity):
+        """to be called after an entity moved"""
+        if self._bucket_of(entity.xy) != self._entity_bucket[entity]:
+            self.remove(entity)
+            self.insert(entity)
+
+    def _candidates(self, xy, radius):
+        bx0, by0 = self._bucket_of((xy[0] - radius, xy[1] - radius))
+        bx1, by1 = self._bucket_of((xy[0] + radius, xy[1] + radius))
+        if (bx1 - bx0 + 1) * (by1 - by0 + 1) <= len(self._buckets):
+            for bx in range(bx0, bx1 + 1):
+                for by in range(by0, by1 + 1):
+                    if (bx, by) in self._buckets:
+                        yield from self._buckets[(bx, by)]
+        else:
+            # sparse case, cheaper to visit the occupied buckets only
+            for (bx, by), content in self._buckets.items():
+                if bx0 <= bx <= bx1 and by0 <= by <= by1:
+                    yield from content
+
+    def query_radius(self, xy, radius):
+        return [e for e in self._candidates(xy, radius) if e.xy.distance_to(xy) <= radius]
+
+    def query_view(self, xy, direction, half_fov, max_depth):
+        """entities in front of xy that can be (partially) seen within half_fov degrees of direction"""
+        res = []
+        for e in self._candidates(xy, max_depth):
+            to_ent = e.xy - xy
+            dist = to_ent.length()
+            if 0 < dist <= max_depth:
+                angle = (direction.angle_to(to_ent) + 180) % 360 - 180
+                if abs(angle) <= half_fov + math.degrees(math.atan2(e.width, dist)):
+                    res.append(e)
+        return res
+
+
 class GameState:
+    BATCH_MIN_RAYS = 200  # below this, the numpy setup costs more than casting rays one by one
 
     def __init__(self, player: Player, world: GameWorld, ents=()):
         self.player = player
@@ -195,8 +1315,16 @@ class GameState:
         self.entities = []
         self.game_over = False
         self.total_stars = 0
+        self._n_stars = 0
+        self.spatial_hash = SpatialHash(world.cell_size)
 
         self.ray_states = []
+        self._ray_states_key = None
+        self.batch_caster = BatchRayCaster(world) if np is not None and world.has_index_grid else None
+        self.parallel_caster = None
+        self.visibility = VisibilityIndex(self)
+        self.ai = AIScheduler(self)
+        self.flow_field = FlowField(self)
         for e in ents:
             self.add_entity(e)
 
@@ -204,14 +1332,30 @@ class GameState:
 
     def add_entity(self, entity):
         self.entities.append(entity)
+        self.spatial_hash.insert(entity)
         if isinstance(entity, Pickup) and not entity.is_empty():
             self.total_stars += 1
+            self._n_stars += 1
 
     def remove_entity(self, entity):
         self.entities.remove(entity)
+        self.spatial_hash.remove(entity)
+        self.ai.forget(entity)
+        if isinstance(entity, Pickup) and not entity.is_empty():
+            self._n_stars -= 1
+
+    def move_entity(self, entity, xy):
+        entity.xy = xy
+        self.spatial_hash.update(entity)
+
+    def entities_near(self, xy, radius):
+        return self.spatial_hash.query_radius(xy, radius)
+
+    def entities_in_view(self, emitter: RayEmitter):
+        return self.spatial_hash.query_view(emitter.xy, emitter.direction, emitter.fov[0] / 2, emitter.max_depth)
 
     def n_stars_remaining(self):
-        return len([e for e in self.entities if isinstance(e, Pickup) and not e.is_empty()])
+        return self._n_stars
 
     def kill_player(self, killed_by):
         print("Player was killed by", killed_by.name)
@@ -223,13 +1367,41 @@ class GameState:
     def is_win(self):
         return self.n_stars_remaining() == 0
 
+    def enable_parallel_casting(self, n_workers=None):
+        """casts the player rays over a pool of worker processes, until disable_parallel_casting is called"""
+        self.disable_parallel_casting()
+        self.parallel_caster = ParallelRayCaster(self.world, n_workers)
+
+    def disable_parallel_casting(self):
+        if self.parallel_caster is not None:
+            self.parallel_caster.close()
+            self.parallel_caster = None
+
+    def close(self):
+        """releases the worker processes of parallel casting, if any. Call it when the state gets replaced"""
+        self.disable_parallel_casting()
+
     def update_ray_states(self):
+        if self.parallel_caster is not None:
+            self.ray_states = self.parallel_caster.cast_ray_states(self.player)
+            return
+        if self.batch_caster is not None and self.player.n_rays >= self.BATCH_MIN_RAYS:
+            self.ray_states = self.batch_caster.cast_ray_states(self.player)
+            return
         self.ray_states.clear()
         i = 0
         for ray in self.player.get_rays():
             self.ray_states.append(self.cast_ray(i, self.player.xy, ray, self.player.max_depth))
             i += 1
 
+    def refresh_ray_states(self):
+        """casts the rays again only if the player's view or the walls changed since the last cast"""
+        p = self.player
+        key = (p.xy[0], p.xy[1], p.direction[0], p.direction[1], p.fov, p.n_rays, p.max_depth, self.world.revision)
+        if key != self._ray_states_key:
+            self.update_ray_states()
+            self._ray_states_key = key
+
     def has_line_of_sight(self, start_xy, end_xy):
         ray = (end_xy - start_xy)
         ray.scale_to_length(1)
@@ -252,7 +1424,9 @@ class GameState:
             else:
                 return xy  # failed
 
-        if buffer_zone > 0:
+        dist_field = self.world.distance_field
+        if buffer_zone > 0 and (dist_field is None
+                                or (dist_field.get_at(res_xy[0], res_xy[1]) - 1) * self.world.cell_size <= buffer_zone):
             ortho_dists = self.ortho_distances_to_walls(res_xy, max_dist=buffer_zone)
             for adir in ortho_dists.keys():
                 if ortho_dists[adir] <= buffer_zone:
@@ -261,6 +1435,22 @@ class GameState:
 
         return res_xy
 
+    def get_closest_unobstructed_positions(self, positions, buffer_zone=4):
+        """get_closest_unobstructed_pos for many positions, those far enough from walls being sorted out at once"""
+        dist_field = self.world.distance_field
+        if np is None or dist_field is None or len(positions) < 2:
+            return [self.get_closest_unobstructed_pos(xy, buffer_zone) for xy in positions]
+        cs = self.world.cell_size
+        w, h = self.world.get_dims()
+        cells = np.array([(xy[0], xy[1]) for xy in positions], dtype=np.float64) / cs
+        cells = np.floor(cells).astype(np.int64)  # same as get_cell_coords_at for positions inside the world
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < w) & (cells[:, 1] >= 0) & (cells[:, 1] < h)
+        dists = np.zeros(len(positions), dtype=np.int64)
+        dists[inside] = dist_field.get_grid()[cells[inside, 0], cells[inside, 1]]
+        clear = (dists - 1) * cs > buffer_zone
+        return [xy if is_clear else self.get_closest_unobstructed_pos(xy, buffer_zone)
+                for xy, is_clear in zip(positions, clear)]
+
     dirs = [
         (0,1),
         (-1,0),
@@ -302,7 +1492,10 @@ class GameState:
         maxX = start_xy[0] + ray[0] * max_dist
         maxY = start_xy[1] + ray[1] * max_dist
 
-        if ray.length() > 0:
+        dist_field = self.world.distance_field if not antiray else None
+        ray_len = ray.length()
+
+        if ray_len > 0:
             while ((curX <= maxX if ray[0] >= 0 else curX >= maxX)
                    and (curY <= maxY if ray[1] >= 0 else curY >= maxY)):
 
@@ -311,6 +1504,16 @@ class GameState:
                     if (color_at_cur_xy is not None) != antiray:
                         return RayState(idx, start_xy, Vector2(curX, curY), ray, color_at_cur_xy)
 
+                if dist_field is not None:
+                    skip = dist_field.get((tileX, tileY)) - 1
+                    if skip > 0:
+                        # no wall within `skip` cells, so we can jump that far in one go
+                        t = t + skip * cell_size / ray_len
+                        curX = start_xy[0] + ray[0] * t
+                        curY = start_xy[1] + ray[1] * t
+                        tileX, tileY = int(curX / cell_size), int(curY / cell_size)
+                        continue
+
                 dtX = float('inf') if ray[0] == 0 else ((tileX + tileOffsetX) * cell_size - curX) / ray[0]
                 dtY = float('inf') if ray[1] == 0 else ((tileY + tileOffsetY) * cell_size - curY) / ray[1]
 
@@ -354,10 +1557,77 @@ def lerp_color(c1, c2, a):
     return bound(round_tuple(lerp(c1, c2, a)), 0, 255)
 
 
+class FogTable:
+    """
+        Precomputed shades of each wall color, n_steps of them going from the color itself (distance 0)
+        to the background color (max distance), so that renderers don't call lerp_color once per ray.
+        Rows are built on the first lookup of a color, and all dropped when the background color changes.
+    """
+
+    def __init__(self, n_steps=128, max_colors=4096):
+        self.n_steps = n_steps
+        self.max_colors = max_colors
+        self._bg_color = None
+        self._shades = dict()
+
+    def sync(self, bg_color):
+        if bg_color != self._bg_color or len(self._shades) > self.max_colors:
+            self._bg_color = bg_color
+            self._shades.clear()
+
+    def get(self, color, a):
+        """same as lerp_color(color, bg_color, a) up to the quantization of a"""
+        shades = self._shades.get(color)
+        if shades is None:
+            last = self.n_steps - 1
+            shades = [lerp_color(color, self._bg_color, i / last) for i in range(self.n_steps)]
+            self._shades[color] = shades
+        i = int(a * (self.n_steps - 1) + 0.5)
+        return shades[0 if i < 0 else (i if i < self.n_steps else -1)]
+
+
 class RayCastRenderer:
+    MAP_COLORKEY = (0xFF, 0x00, 0xFF)
+    MAX_MAP_PIXELS = 2048 * 2048  # bigger worlds get their walls drawn cell by cell
 
     def __init__(self):
-        pass
+        self.fog = FogTable()
+        self._map_surf = None
+        self._map_world = None
+        self._map_revision = None
+
+    def _draw_map_cell(self, world, xy):
+        cs = world.cell_size
+        color = world.get_cell(xy)
+        self._map_surf.fill(color if color is not None else self.MAP_COLORKEY, [xy[0] * cs, xy[1] * cs, cs, cs])
+
+    def get_map_surface(self, world: GameWorld):
+        """
+            The wall layer of the whole world, rendered once then patched with the cells changed through set_cell.
+            Returns None when the world is too big to be cached.
+        """
+        if self._map_world is not world:
+            self._map_world = world
+            size = world.get_size()
+            if size[0] * size[1] > self.MAX_MAP_PIXELS:
+                self._map_surf = None
+                return None
+            self._map_surf = pygame.Surface(size)
+            self._map_surf.fill(self.MAP_COLORKEY)
+            self._map_surf.set_colorkey(self.MAP_COLORKEY)
+            for xy in world.all_cells():
+                if world.get_cell(xy) is not None:
+                    self._draw_map_cell(world, xy)
+            self._map_revision = world.revision
+
+        elif self._map_surf is not None and self._map_revision != world.revision:
+            changes = world.get_changes_since(self._map_revision)
+            for xy in (changes if changes is not None else world.all_cells()):
+                if world.is_valid(xy):
+                    self._draw_map_cell(world, xy)
+            self._map_revision = world.revision
+
+        return self._map_surf
 
     def render(self, screen, state: GameState):
         p_xy = state.player.xy
@@ -368,22 +1638,28 @@ class RayCastRenderer:
                            -p_xy[1] + screen_size[1] // 2)
 
         bg_color = lerp_color(state.world.bg_color, (255, 255, 255), 0.05)
+        self.fog.sync(bg_color)
 
         for r in state.ray_states:
             color = r.color if r.color is not None else bg_color
             if r.end is not None:
-                color = lerp_color(color, bg_color, r.dist() / state.player.max_depth)
+                color = self.fog.get(color, r.dist() / state.player.max_depth)
                 pygame.draw.line(screen, color, r.start + cam_offs, r.end + cam_offs)
             else:
                 pygame.draw.line(screen, color, r.start + cam_offs, r.start + r.ray * state.player.max_depth + cam_offs)
 
-        camera_rect = [p_xy[0] - screen_size[0] // 2, p_xy[1] - screen_size[1] // 2, screen_size[0], screen_size[1]]
-
-        for xy in state.world.all_cells(in_rect=camera_rect):
-            color = state.world.get_cell(xy)
-            if color is not None:
-                r = [xy[0] * cs + cam_offs[0], xy[1] * cs + cam_offs[1], cs, cs]
-                pygame.draw.rect(screen, color, r)
+        # walls are placed at the floored offset, the pixel the rays and entities start from
+        # (pygame.draw truncates towards zero, which only differs for cells partly above or left of the screen)
+        map_x, map_y = math.floor(cam_offs[0]), math.floor(cam_offs[1])
+        map_surf = self.get_map_surface(state.world)
+        if map_surf is not None:
+            screen.blit(map_surf, (map_x, map_y))
+        else:
+            camera_rect = [p_xy[0] - screen_size[0] // 2, p_xy[1] - screen_size[1] // 2, screen_size[0], screen_size[1]]
+            for xy in state.world.all_cells(in_rect=camera_rect):
+                color = state.world.get_cell(xy)
+                if color is not None:
+                    pygame.draw.rect(screen, color, [xy[0] * cs + map_x, xy[1] * cs + map_y, cs, cs])
 
         for ent in state.entities:
             rect = ent.get_rect()
@@ -392,33 +1668,54 @@ class RayCastRenderer:
             pygame.draw.rect(screen, color, rect, 1)
 
 
+class ProjectionTable:
+    """
+        Screen rows (top, bottom) of a wall column as a function of the wall distance, quantized to 1/resolution.
+        Rows are computed on first use of a distance bucket, and forgotten whenever the wall height, eye level,
+        vertical fov or screen height change.
+    """
+
+    def __init__(self, resolution=16):
+        self.resolution = resolution
+        self._key = None
+        self._rows = dict()
+
+    def get(self, dist, wall_height, eye_level, half_fovy, screen_h):
+        key = (wall_height, eye_level, half_fovy, screen_h)
+        if key != self._key:
+            self._key = key
+            self._rows.clear()
+        bucket = int(dist * self.resolution)
+        res = self._rows.get(bucket)
+        if res is None:
+            d = (bucket + 0.5) / self.resolution
+            theta_upper = math.degrees(math.atan2(wall_height - eye_level, d))
+            theta_lower = abs(math.degrees(math.atan2(eye_level, d)))
+            rect_y1 = 0 if theta_upper >= half_fovy else screen_h // 2 * (1 - theta_upper / half_fovy)
+            rect_y2 = screen_h if theta_lower >= half_fovy else screen_h // 2 * (1 + theta_lower / half_fovy)
+            res = self._rows[bucket] = (rect_y1, rect_y2)
+        return res
+
+
 class RayCastRenderer3D(RayCastRenderer):
+    sprite_cache = SpriteCache()  # shared by all instances, so that it survives render mode switches
 
     def __init__(self):
         super().__init__()
         self.wall_height = 5
         self.eye_level = 2.7
+        self.projection = ProjectionTable()
 
     def render(self, screen, state: GameState):
         n_rays = len(state.ray_states)
         bg_color = lerp_color(state.world.bg_color, (255, 255, 255), 0.05)
+        self.fog.sync(bg_color)
         p_xy = state.player.xy
-        p_dir = state.player.direction
 
         screen_size = screen.get_size()
         half_fovy = state.player.fov[1] / 2
-        half_fovx = state.player.fov[0] / 2
-
-        things_to_render = []
-
-        for ent in state.entities:
-            direction_to_ent = ent.xy - p_xy
-            if 0 < direction_to_ent.length() <= state.player.max_depth:
-                angle_to_ent = p_dir.angle_to(direction_to_ent)
-                if angle_to_ent <= half_fovx:
-                    # it's onscreen
-                    things_to_render.append(ent)
 
+        things_to_render = state.entities_in_view(state.player)
         things_to_render.extend([r for r in state.ray_states if r.end is not None])
         sort_key = lambda r: r.dist() if isinstance(r, RayState) else r.xy.distance_to(p_xy)
         things_to_render.sort(key=sort_key, reverse=True)
@@ -428,52 +1725,245 @@ class RayCastRenderer3D(RayCastRenderer):
         for r in things_to_render:
             if isinstance(r, RayState):
                 i = r.idx
-                color = lerp_color(r.color, bg_color, r.dist() / state.player.max_depth)
-                theta_upper = math.degrees(math.atan2(self.wall_height - cur_eye_level, r.dist()))
-                theta_lower = abs(math.degrees(math.atan2(cur_eye_level, r.dist())))
-                rect_y1 = 0 if theta_upper >= half_fovy else screen_size[1] // 2 * (1 - theta_upper / half_fovy)
-                rect_y2 = screen_size[1] if theta_lower >= half_fovy else screen_size[1] // 2 * (1 + theta_lower / half_fovy)
+                color = self.fog.get(r.color, r.dist() / state.player.max_depth)
+                rect_y1, rect_y2 = self.projection.get(r.dist(), self.wall_height, cur_eye_level, half_fovy, screen_size[1])
                 rect_x1 = int(screen_size[0] * i / n_rays)
                 rect_x2 = int(screen_size[0] * (i + 1) / n_rays)
                 screen_rect = [rect_x1, int(rect_y1), rect_x2 - rect_x1 + 1, int(rect_y2 - rect_y1 + 1)]
                 pygame.draw.rect(screen, color, screen_rect)
             elif isinstance(r, Entity):
-                to_ent = r.xy - p_xy
-                angle_from_left = p_dir.rotate(-half_fovx).angle_to(to_ent)
-                theta_upper = math.degrees(math.atan2(r.height - cur_eye_level, to_ent.length()))
-                theta_lower = abs(math.degrees(math.atan2(cur_eye_level, to_ent.length())))
-                rect_y1 = 0 if theta_upper >= half_fovy else screen_size[1] // 2 * (1 - theta_upper / half_fovy)
-                rect_y2 = screen_size[1] if theta_lower >= half_fovy else screen_size[1] // 2 * (1 + theta_lower / half_fovy)
-                rect_height = rect_y2 - rect_y1 + 1
-                rect_width = rect_height / r.height * r.width
-                rect_cx = angle_from_left / (half_fovx * 2) * screen_size[0]
-                screen_rect = [int(rect_cx - rect_width / 2), int(rect_y1), int(rect_width), int(rect_height)]
-
-                # XXX pygame.transform.scale doesn't work in web mode~
-                if r.image is not None and not kataen.runs_in_web():
-                    dest_surf = pygame.Surface((screen_rect[2], screen_rect[3]))
-                    dest_surf.set_colorkey(r.image.get_colorkey())
-                    xformed_img = pygame.transform.scale(r.image, (screen_rect[2], screen_rect[3]), dest_surf)
+                screen_rect = self.get_entity_screen_rect(r, state, screen_size)
+                xformed_img = self.get_entity_image(r, screen_rect)
+                if xformed_img is not None:
                     screen.blit(xformed_img, (screen_rect[0], screen_rect[1]))
                 else:
                     pygame.draw.rect(screen, r.get_color_2d(), screen_rect, 2)
 
+    def get_entity_screen_rect(self, ent, state: GameState, screen_size):
+        half_fovy = state.player.fov[1] / 2
+        half_fovx = state.player.fov[0] / 2
+        cur_eye_level = self.eye_level + state.player.z
+
+        to_ent = ent.xy - state.player.xy
+        angle_from_left = state.player.direction.rotate(-half_fovx).angle_to(to_ent)
+        angle_from_left = (angle_from_left + 180) % 360 - 180
+        theta_upper = math.degrees(math.atan2(ent.height - cur_eye_level, to_ent.length()))
+        theta_lower = abs(math.degrees(math.atan2(cur_eye_level, to_ent.length())))
+        rect_y1 = 0 if theta_upper >= half_fovy else screen_size[1] // 2 * (1 - theta_upper / half_fovy)
+        rect_y2 = screen_size[1] if theta_lower >= half_fovy else screen_size[1] // 2 * (1 + theta_lower / half_fovy)
+        rect_height = rect_y2 - rect_y1 + 1
+        rect_width = rect_height / ent.height * ent.width
+        rect_cx = angle_from_left / (half_fovx * 2) * screen_size[0]
+        return [int(rect_cx - rect_width / 2), int(rect_y1), int(rect_width), int(rect_height)]
+
+    def get_entity_image(self, ent, screen_rect):
+        """returns the entity image scaled to screen_rect, or None when it can't be drawn as an image"""
+        # XXX pygame.transform.scale doesn't work in web mode~
+        if ent.image is None or kataen.runs_in_web():
+            return None
+        return self.sprite_cache.get(ent.image, (screen_rect[2], screen_rect[3]))
+
+
+class ColumnBufferRenderer3D(RayCastRenderer3D):
+    """
+        3D renderer that fills all the wall columns into a pixel buffer in one vectorized pass, then draws them
+        with a single blit, while keeping a per-column depth buffer. Sprites then get depth-tested against the walls,
+        instead of sorting walls and sprites together. Needs numpy.
+    """
+    WALL_COLORKEY = (255, 0, 255)  # pixels of the wall layer without a wall
+
+    def __init__(self):
+        super().__init__()
+        self.depth_buffer = None
+        self._columns_key = None
+        self._columns = None
+        self._wall_layer = None
+        self._rows = None
+        self._layers = None
+
+    def render(self, screen, state: GameState):
+        self.fill_wall_columns(screen, state)
+
+        p_xy = state.player.xy
+        ents = state.entities_in_view(state.player)
+        ents.sort(key=lambda e: e.xy.distance_to(p_xy), reverse=True)
+        for ent in ents:
+            self.draw_entity(screen, ent, state)
+
+    def get_column_rays(self, n_rays, screen_w):
+        """
+            Which ray rects cover every screen column, the rects of neighbouring rays sharing their edge column.
+            Returns (last, layer_rows, n_layers): the index of the last ray covering each column, the row of
+            the layer stack (see fill_wall_columns) each column is copied from, and the number of layers needed
+        """
+        key = (n_rays, screen_w)
+        if key != self._columns_key:
+            i = np.arange(n_rays)
+            cols = np.arange(screen_w)
+            last = np.searchsorted((screen_w * i / n_rays).astype(np.int64), cols, side='right') - 1
+            first = np.searchsorted((screen_w * (i + 1) / n_rays).astype(np.int64), cols, side='left')
+            n_under = last - first  # how many earlier rays also cover the column
+            self._columns = (last, last + n_rays * n_under, int(n_under.max()) + 1)
+            self._columns_key = key
+        return self._columns
+
+    def _get_wall_layer(self, screen):
+        layer = self._wall_layer
+        if layer is None or layer.get_size() != screen.get_size() or layer.get_bitsize() != screen.get_bitsize():
+            layer = self._wall_layer = pygame.Surface(screen.get_size(), 0, screen)
+            layer.set_colorkey(self.WALL_COLORKEY)
+            self._rows = np.arange(screen.get_height(), dtype=np.int16)
+        return layer
+
+    def fill_wall_columns(self, screen, state: GameState):
+        screen_w, screen_h = screen.get_size()
+        n_rays = len(state.ray_states)
+        if n_rays == 0:
+            self.depth_buffer = np.full(screen_w, np.inf)
+            return
+        self.fog.sync(lerp_color(state.world.bg_color, (255, 255, 255), 0.05))
+        half_fovy = state.player.fov[1] / 2
+        cur_eye_level = self.eye_level + state.player.z
+        max_depth = state.player.max_depth
+        layer = self._get_wall_layer(screen)
+        key = layer.map_rgb(self.WALL_COLORKEY)
+
+        # per ray: depth, first row and number of rows, and color mapped to the pixel format
+        dists = [math.inf] * n_rays
+        tops = [0] * n_rays
+        heights = [0] * n_rays
+        colors = [key] * n_rays
+        for i, r in enumerate(state.ray_states):
+            if r.end is None:
+                continue
+            d = dists[i] = r.dist()
+            rect_y1, rect_y2 = self.projection.get(d, self.wall_height, cur_eye_level, half_fovy, screen_h)
+            tops[i] = int(rect_y1)
+            heights[i] = max(0, int(rect_y2 - rect_y1 + 1))
+            color = layer.map_rgb(self.fog.get(r.color, d / max_depth))
+            colors[i] = color if color != key else color ^ 1  # a wall mustn't turn transparent
+
+        # n_rays x screen_h image of the walls, with a single comparison per pixel
+        rows_in_wall = ((self._rows - np.array(tops, dtype=np.int16)[:, None]).view(np.uint16)
+                        < np.array(heights, dtype=np.uint16)[:, None])
+        colors = np.array(colors, dtype=np.uint32)[:, None]
+        last, layer_rows, n_layers = self.get_column_rays(n_rays, screen_w)
+        if self._layers is None or self._layers.shape != (n_layers * n_rays, screen_h):
+            self._layers = np.empty((n_layers * n_rays, screen_h), dtype=np.uint32)
+        # rays are drawn in order, so in a column shared by several rects the last ray shows on its rows and the
+        # earlier ones around them: layer k holds every ray drawn over the k rays before it
+        layers = self._layers
+        walls = layers[:n_rays]
+        walls.fill(key)
+        np.copyto(walls, colors, where=rows_in_wall)
+        for k in range(1, n_layers):
+            below = layers[(k - 1) * n_rays:k * n_rays]
+            over = layers[k * n_rays:(k + 1) * n_rays]
+            over[0] = walls[0]
+            over[1:] = below[:-1]
+            np.copyto(over, colors, where=rows_in_wall)
+
+        pygame.surfarray.blit_array(layer, layers[layer_rows])
+        screen.blit(layer, (0, 0))
+        self.depth_buffer = np.array(dists)[last]
+
+    def draw_entity(self, screen, ent, state: GameState):
+        screen_w = screen.get_width()
+        screen_rect = self.get_entity_screen_rect(ent, state, screen.get_size())
+        x0 = max(screen_rect[0], 0)
+        x1 = min(screen_rect[0] + screen_rect[2], screen_w)
+        if x1 <= x0 or screen_rect[3] <= 0:
+            return
+        visible = self.depth_buffer[x0:x1] > ent.xy.distance_to(state.player.xy)
+        if not visible.any():
+            return
+        xformed_img = self.get_entity_image(ent, screen_rect)
+        if xformed_img is None:
+            pygame.draw.rect(screen, ent.get_color_2d(), screen_rect, 2)
+            return
+        # blit the runs of columns that pass the depth test
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], visible.astype(np.int8), [0]))))
+        for start, end in zip(edges[::2], edges[1::2]):
+            area = [x0 + start - screen_rect[0], 0, end - start, screen_rect[3]]
+            screen.blit(xformed_img, (x0 + start, screen_rect[1]), area)
+
+
+# (name, sprite index, position relative to the map size, Enemy kwargs)
+ENEMY_TEMPLATES = [
+    ("Skulker", 0, (0.25, 0.25), dict(move_speed=25, aggro_cooldown=15)),
+    ("Observer", 1, (0.75, 0.25), dict(move_speed=30, sight=200)),
+    ("Remorse", 2, (0.75, 0.75), dict(move_speed=40, sight=90, aggro_cooldown=10)),
+    ("Conjurer", 3, (0.25, 0.75), dict(move_speed=20, turn_speed=90, sight=150)),
+]
+
+
+def build_game_state(grid_dims=(64, 48), cell_size=16, n_enemies=4, n_stars=4, n_rays=60, sight=200):
+    """builds a random map, with the player at its center. Enemies past the first four get random positions"""
+    W, H = grid_dims
+    w = CompactGameWorld((W, H), cell_size).randomize()
+    xy = Vector2(w.get_width() / 2, w.get_height() / 2)
+    p = Player(xy, fov=(60, 45), n_rays=n_rays, move_speed=50, turn_speed=160, sight=sight)
+
+    ents = []
+    for i in range(n_enemies):
+        name, sprite_idx, rel_xy, kwargs = ENEMY_TEMPLATES[i % len(ENEMY_TEMPLATES)]
+        if i < len(ENEMY_TEMPLATES):
+            pos = Vector2(W * rel_xy[0] * cell_size, H * rel_xy[1] * cell_size)
+        else:
+            name = "{} {}".format(name, i // len(ENEMY_TEMPLATES) + 1)
+            pos = Vector2(cell_size * (0.5 + random.randint(1, W - 2)),
+                          cell_size * (0.5 + random.randint(1, H - 2)))
+        ents.append(Enemy(name, Art.ENEMIES[sprite_idx], pos, sprite_idx=sprite_idx, **kwargs))
+    for i in range(n_stars):
+        pos = Vector2(cell_size * (0.5 + random.randint(0, W - 1)),
+                      cell_size * (0.5 + random.randint(0, H - 1)))
+        ents.append(Pickup("Pickup {}".format(i+1), Art.PICKUPS[i % 4], pos, i % 4))
+
+    # clear cells adjacent to player and entities
+    for e in ents + [p]:
+        cell = w.get_cell_coords_at(e.xy[0], e.xy[1])
+        for x in range(cell[0] - 1, cell[0] + 2):
+            for y in range(cell[1] - 1, cell[1] + 2):
+                w.set_cell((x, y), None)
+    w.enable_distance_field()
+
+    return GameState(p, w, ents=ents)
+
 
 def rect_contains(rect, pt):
     return rect[0] <= pt[0] < rect[0] + rect[2] and rect[1] <= pt[1] < rect[1] + rect[3]
 
 
+def lerp_pose(pose1, pose2, a):
+    """pose between two (xy, direction, z) player poses, the direction is interpolated by angle"""
+    angle = pose1[1].angle_to(pose2[1])
+    angle = (angle + 180) % 360 - 180
+    return pose1[0] + (pose2[0] - pose1[0]) * a, pose1[1].rotate(angle * a), lerp(pose1[2], pose2[2], a)
+
+
 class RayCasterGame(BaseGame):
+    MAX_TICKS_PER_UPDATE = 5  # when a frame is late, the simulation is slowed down rather than catching up forever
 
-    def __init__(self):
+    def __init__(self, profile_log=None, map_path=None, tick_rate=None):
         super().__init__(True)  # fps tracking
         
         self.state = None
+        self.map_path = map_path  # when None, every reset generates a random map
+
+        # when tick_rate is set, the simulation advances by fixed steps of 1 / tick_rate seconds,
+        # and render() draws the player pose interpolated between the last two steps
+        self.tick_rate = tick_rate
+        self._time_accumulator = 0.0
+        self._prev_pose = None
+        self._runs_in_web_ctx = kataen.runs_in_web()
         self.renderer = RayCastRenderer3D()
         self.show_controls = True
 
+        self.profiler = FrameProfiler(log_path=profile_log)
+        self.show_profiler = False
+        self._profiler_text = ""
+
         self._info_font = None
-        self._runs_in_web_ctx = kataen.runs_in_web()
 
     def render_text(self, screen, text, size=12, pos=(0, 0), xanchor=0, color=(255, 255, 255), bg_color=None):
         if self._info_font is None or self._info_font.get_height() != size:
@@ -486,44 +1976,43 @@ class RayCasterGame(BaseGame):
             y += surf.get_height()
 
     def _build_initial_state(self):
-        W, H = 64, 48
-        CELL_SIZE = 16
-        N_STARS = 4
-
-        w = GameWorld((W, H), CELL_SIZE).randomize()
-        xy = Vector2(w.get_width() / 2, w.get_height() / 2)
-        p = Player(xy, fov=(60, 45), n_rays=60, move_speed=50, turn_speed=160, sight=200)
-
-        ents = [
-            Enemy("Skulker", Art.ENEMIES[0], Vector2(W * 0.25 * CELL_SIZE, H * 0.25 * CELL_SIZE), move_speed=25, aggro_cooldown=15),
-            Enemy("Observer", Art.ENEMIES[1], Vector2(W * 0.75 * CELL_SIZE, H * 0.25 * CELL_SIZE), move_speed=30, sight=200),
-            Enemy("Remorse", Art.ENEMIES[2], Vector2(W * 0.75 * CELL_SIZE, H * 0.75 * CELL_SIZE), move_speed=40, sight=90, aggro_cooldown=10),
-            Enemy("Conjurer", Art.ENEMIES[3], Vector2(W * 0.25 * CELL_SIZE, H * 0.75 * CELL_SIZE), move_speed=20, turn_speed=90, sight=150)
-        ]
-        for i in range(N_STARS):
-            pos = Vector2(CELL_SIZE * (0.5 + random.randint(0, W - 1)),
-                          CELL_SIZE * (0.5 + random.randint(0, H - 1)))
-            ents.append(Pickup("Pickup {}".format(i+1), Art.PICKUPS[i % 4], pos))
-
-        # clear cells adjacent to player and entities
-        for e in ents + [p]:
-            cell = w.get_cell_coords_at(e.xy[0], e.xy[1])
-            for x in range(cell[0] - 1, cell[0] + 2):
-                for y in range(cell[1] - 1, cell[1] + 2):
-                    w.set_cell((x, y), None)
-
-        return GameState(p, w, ents=ents)
+        if self.map_path is not None:
+            return load_map(self.map_path)
+        return build_game_state()
 
     def get_mode(self):
         return 'SUPER_RETRO'
 
     def pre_update(self):
-        Art.load_from_disk()
+        if self._runs_in_web_ctx:  # XXX no threads in web mode~
+            Art.load_from_disk()
+        else:
+            Art.load_in_background(build_mips=np is not None)
+        RayCastRenderer3D.sprite_cache.clear()
 
     def update(self, events, dt):
+        if Art.poll():
+            RayCastRenderer3D.sprite_cache.clear()
         if self.state is None:
             self.state = self._build_initial_state()
-        
+
+        self.profiler.begin('input')
+        forward, strafe, turn = self._handle_input(events)
+        self.profiler.end('input')
+
+        if self.tick_rate is None:
+            self.advance(forward, strafe, turn, dt)
+            return
+
+        step = 1 / self.tick_rate
+        self._time_accumulator = min(self._time_accumulator + dt, self.MAX_TICKS_PER_UPDATE * step)
+        while self._time_accumulator >= step:
+            self._prev_pose = self.state.player.get_pose()
+            self.advance(forward, strafe, turn, step, cast_rays=False)
+            self._time_accumulator -= step
+
+    def _handle_input(self, events):
+        """processes key/mouse events, returns the (forward, strafe, turn) player inputs"""
         if not self._runs_in_web_ctx:  # calling set_caption is not always useful
             if self.get_tick() % 20 == 0:
                 dims = self.get_screen_size()
@@ -536,7 +2025,9 @@ class RayCasterGame(BaseGame):
             if e.type == pygame.KEYDOWN:
                 if e.key == pygame.K_r:
                     print("Resetting! [pressed R]")
+                    self.state.close()
                     self.state = self._build_initial_state()
+                    self._prev_pose = None
                 elif e.key == pygame.K_f:
                     if isinstance(self.renderer, RayCastRenderer3D):
                         print("Switching render mode to 2D. [pressed F]")
@@ -546,6 +2037,8 @@ class RayCasterGame(BaseGame):
                         self.renderer = RayCastRenderer3D()
                 elif e.key == pygame.K_c:
                     self.show_controls = not self.show_controls
+                elif e.key == pygame.K_p:
+                    self.show_profiler = not self.show_profiler
                 elif e.key == pygame.K_SPACE:
                     if not self.state.is_game_over():
                         self.state.player.jump()
@@ -584,23 +2077,51 @@ class RayCasterGame(BaseGame):
             if pressed[pygame.K_d]:
                 strafe += 1
 
+        return forward, strafe, turn
+
+    def advance(self, forward, strafe, turn, dt, cast_rays=True):
+        """runs one simulation step of the current state, given the player inputs"""
+        prof = self.profiler
+        prof.begin('player')
         self.state.player.turn(turn, dt)
         self.state.player.move(forward, strafe, dt, state=self.state)
         self.state.player.update(dt)
+        prof.end('player')
+
+        prof.begin('enemies')
+        player_xy = self.state.player.xy
+        self.state.ai.update(dt)
 
-        for ent in list(self.state.entities):
-            ent.update(self.state, dt)
-            if not self.state.is_game_over() and self.state.player.xy.distance_to(ent.xy) <= ent.radius:
+        for ent in self.state.entities_near(player_xy, self.state.spatial_hash.max_radius):
+            if not self.state.is_game_over() and player_xy.distance_to(ent.xy) <= ent.radius:
                 ent.on_collide_with_player(self.state)
+        prof.end('enemies')
 
-        self.state.update_ray_states()
+        if cast_rays:
+            prof.begin('rays')
+            self.state.refresh_ray_states()
+            prof.end('rays')
 
         if not self.state.is_game_over():
             self.state.ellapsed_time += dt
 
     def render(self, screen):
+        player = self.state.player
+        pose = None
+        if self.tick_rate is not None:
+            pose = player.get_pose()
+            if self._prev_pose is not None:
+                player.set_pose(lerp_pose(self._prev_pose, pose, self._time_accumulator * self.tick_rate))
+            self.profiler.begin('rays')
+            self.state.refresh_ray_states()
+            self.profiler.end('rays')
+
+        self.profiler.begin('render')
         screen.fill((0, 0, 0))
         self.renderer.render(screen, self.state)
+        self.profiler.end('render')
+        if pose is not None:
+            player.set_pose(pose)
 
         fps_text = "FPS {:.1f}".format(self.get_fps())
         if self.show_controls:
@@ -608,8 +2129,10 @@ class RayCasterGame(BaseGame):
             movekeys = "[WASDQE] or [arrows] to move"
             r_to_reset = "[R] to reset"
             f_to_swap_modes = "[F] to change to " + ("2D" if isinstance(self.renderer, RayCastRenderer3D) else "3D")
+            p_to_toggle_profiler = "[P] to " + ("hide" if self.show_profiler else "show") + " profiler"
             c_to_hide_instructions = "[C] to hide controls"
-            full_text = "\n".join([fps_text, movekeys, rays_text, r_to_reset, f_to_swap_modes, c_to_hide_instructions])
+            full_text = "\n".join([fps_text, movekeys, rays_text, r_to_reset, f_to_swap_modes, p_to_toggle_profiler,
+                                   c_to_hide_instructions])
         else:
             c_to_show_instructions = "[C] to show controls"
             full_text = "\n".join([fps_text, c_to_show_instructions])
@@ -630,6 +2153,13 @@ class RayCasterGame(BaseGame):
             self.render_text(screen, text, pos=(screen.get_size()[0] // 2, screen.get_size()[1] // 2),
                              xanchor=0.5, bg_color=(0, 0, 0), size=16)
 
+        if self.show_profiler:
+            if self.profiler.frame_idx % 15 == 0 or not self._profiler_text:
+                self._profiler_text = self.profiler.get_report()
+            self.render_text(screen, self._profiler_text, pos=(screen.get_size()[0], 16), xanchor=1.0,
+                             bg_color=(0, 0, 0), size=16)
+        self.profiler.end_frame()
+
 
 ############## raycaster.py ##############
 
@@ -666,8 +2196,9 @@ class Entity:
 
 class Enemy(Entity):
 
-    def __init__(self, name, image, xy, turn_speed=180, move_speed=25, aggro_cooldown=5, sight=120):
+    def __init__(self, name, image, xy, turn_speed=180, move_speed=25, aggro_cooldown=5, sight=120, sprite_idx=0):
         super().__init__(name, image, xy, 4, 8, 3)
+        self.sprite_idx = sprite_idx  # index of image in Art.ENEMIES, saved in map files
         self.vel = Vector2(0, 1).rotate(360 * random.random())
         self.turn_speed = turn_speed
         self.move_speed = move_speed
@@ -685,8 +2216,15 @@ class Enemy(Entity):
 
     def update(self, state, dt):
         player_xy = state.player.xy
-        if not state.is_game_over() and (self.xy.distance_to(player_xy) < self.sight_radius
-                                         and state.has_line_of_sight(self.xy, player_xy)):
+        sees_player = (not state.is_game_over() and self.xy.distance_to(player_xy) < self.sight_radius
+                       and state.visibility.has_line_of_sight(self.xy, player_xy))
+        new_pos = self.think(state, dt, sees_player)
+        self.finish_move(state, new_pos, state.get_closest_unobstructed_pos(new_pos), dt)
+
+    def think(self, state, dt, sees_player):
+        """updates the mood and heading of the enemy, returns where it wants to go (walls ignored)"""
+        player_xy = state.player.xy
+        if not state.is_game_over() and sees_player:
             self.aggro_cooldown = self.max_aggro_cooldown
             if not self.is_aggro:
                 print("{} became aggressive!".format(self.name))
@@ -697,21 +2235,24 @@ class Enemy(Entity):
             self.is_aggro = False
 
         if self.is_aggro:
-            self.vel = player_xy - self.xy
-            self.vel.scale_to_length(1)
+            self.vel = state.flow_field.get_direction(self.xy)
+            if self.vel is None:  # same cell as the player, or too far for the flow field
+                self.vel = player_xy - self.xy
+                if self.vel.length_squared() > 0:
+                    self.vel.scale_to_length(1)
         else:
             # just turn randomly
             self.vel = self.vel.rotate(2 * (random.random() - 0.5) * self.turn_speed * dt)
 
         ms = self.move_speed if self.is_aggro else 0.666 * self.move_speed
-        new_pos = self.xy + self.vel * ms * dt
+        return self.xy + self.vel * ms * dt
 
-        unwalled_new_pos = state.get_closest_unobstructed_pos(new_pos)
+    def finish_move(self, state, new_pos, unwalled_new_pos, dt):
         if not self.is_aggro and unwalled_new_pos != new_pos:
             # it bonked a wall, turn
             self.vel = self.vel.rotate(360 * random.random())
 
-        self.xy = unwalled_new_pos
+        state.move_entity(self, unwalled_new_pos)
         self.aggro_cooldown -= dt
 
     def on_collide_with_player(self, state):
@@ -721,8 +2262,9 @@ class Enemy(Entity):
 
 class Pickup(Entity):
 
-    def __init__(self, name, image, xy):
+    def __init__(self, name, image, xy, sprite_idx=0):
         super().__init__(name, image, xy, 4, 8, 10)
+        self.sprite_idx = sprite_idx  # index of image in Art.PICKUPS, saved in map files
 
     def get_color_2d(self):
         return (0, 255, 255)
@@ -738,7 +2280,7 @@ class Pickup(Entity):
 class EmptyPickup(Pickup):
 
     def __init__(self, xy):
-        super().__init__("Empty Pickup", Art.PICKUPS[-1], xy)
+        super().__init__("Empty Pickup", Art.PICKUPS[-1], xy, len(Art.PICKUPS) - 1)
 
     def get_color_2d(self):
         return (0, 150, 255)
@@ -751,15 +2293,279 @@ class EmptyPickup(Pickup):
 
 ############## entities.py ##############
 
+############## mapfile.py ##############
+
+# header: magic, version, bytes per cell index, distance field max_dist (0 if not stored), width, height,
+# cell size, bg color, player position and direction, number of palette colors (index 0 excluded), number of entities
+MAP_MAGIC = b'RCMP'
+MAP_VERSION = 1
+MAP_HEADER = struct.Struct('<4sHBBIIH3Bx4fII')
+MAP_COLOR = struct.Struct('<3B')
+# kind, sprite index, position, turn_speed, move_speed, aggro_cooldown, sight, name
+MAP_ENTITY = struct.Struct('<BB2x6f24s')
+MAP_ENEMY, MAP_PICKUP, MAP_EMPTY_PICKUP = range(3)
+MAP_ALIGN = 8  # the cell array and the distance field start at multiples of this
+
+
+def _pack_entity(ent):
+    name = ent.name.encode('utf8')[:24].decode('utf8', 'ignore').encode('utf8')  # cut on a character boundary
+    if isinstance(ent, Enemy):
+        return MAP_ENTITY.pack(MAP_ENEMY, ent.sprite_idx, ent.xy[0], ent.xy[1], ent.turn_speed,
+                               ent.move_speed, ent.max_aggro_cooldown, ent.sight_radius, name)
+    kind = MAP_EMPTY_PICKUP if isinstance(ent, EmptyPickup) else MAP_PICKUP
+    return MAP_ENTITY.pack(kind, ent.sprite_idx, ent.xy[0], ent.xy[1], 0, 0, 0, 0, name)
+
+
+def _unpack_entity(buf, offset):
+    kind, sprite_idx, x, y, turn_speed, move_speed, aggro_cooldown, sight, name = MAP_ENTITY.unpack_from(buf, offset)
+    name = name.rstrip(b'\0').decode('utf8')
+    if kind == MAP_ENEMY:
+        return Enemy(name, Art.ENEMIES[sprite_idx], Vector2(x, y), turn_speed=turn_speed, move_speed=move_speed,
+                     aggro_cooldown=aggro_cooldown, sight=sight, sprite_idx=sprite_idx)
+    if kind == MAP_EMPTY_PICKUP:
+        return EmptyPickup(Vector2(x, y))
+    return Pickup(name, Art.PICKUPS[sprite_idx], Vector2(x, y), sprite_idx)
+
+
+def _padding(offset):
+    return -offset % MAP_ALIGN
+
+
+def save_map(state: GameState, path):
+    """
+        writes the world, the player pose and the entities of `state` to `path`, in the binary format read by load_map.
+        The distance field is stored too when the world has one, so loading doesn't have to rebuild it
+    """
+    world = state.world
+    if not world.has_index_grid:
+        raise ValueError("{} has no dense grid to save".format(type(world).__name__))
+    w, h = world.get_dims()
+    if isinstance(world, CompactGameWorld):
+        cells, palette = world.cells, world.palette[1:]
+    else:
+        palette = []
+        color_to_idx = {None: 0}
+        cells = array.array('H', bytes(2 * w * h))
+        for x in range(w):
+            for y in range(h):
+                color = world.get_cell((x, y))
+                if color is not None:
+                    color = tuple(color)
+                if color not in color_to_idx:
+                    palette.append(color)
+                    color_to_idx[color] = len(palette)
+                cells[x * h + y] = color_to_idx[color]
+        if len(palette) < 256:
+            cells = bytearray(cells.tolist())
+    itemsize = getattr(cells, 'itemsize', 1)
+    df = world.distance_field
+    player = state.player
+
+    header = MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, itemsize, df.max_dist if df is not None else 0, w, h,
+                             world.cell_size, *world.bg_color[:3], player.xy[0], player.xy[1],
+                             player.direction[0], player.direction[1], len(palette), len(state.entities))
+    if df is not None:
+        df.refresh()
+    # the cells of a loaded world point into a mapping of its file: write elsewhere, then swap the files,
+    # so saving a map over the file it was loaded from neither truncates it while reading nor breaks the mapping
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for color in palette:
+            f.write(MAP_COLOR.pack(*color[:3]))
+        for ent in state.entities:
+            f.write(_pack_entity(ent))
+        f.write(bytes(_padding(f.tell())))
+        f.write(cells)
+        if df is not None:
+            f.write(bytes(_padding(f.tell())))
+            f.write(df.values)
+    os.replace(tmp_path, path)
+
+
+def load_map(path, n_rays=60, sight=200):
+    """
+        builds a GameState from a file written by save_map. The file is memory-mapped copy-on-write and the world
+        cells point right into it, so only the pages that are actually read get loaded, and editing the world
+        never touches the file
+    """
+    with open(path, 'rb') as f:
+        if mmap is not None:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            data = bytearray(f.read())
+    buf = memoryview(data)
+
+    (magic, version, itemsize, df_max_dist, w, h, cell_size, bg_r, bg_g, bg_b, px, py, dx, dy, n_colors,
+     n_entities) = MAP_HEADER.unpack_from(buf, 0)
+    if magic != MAP_MAGIC or version != MAP_VERSION:
+        raise ValueError("{} isn't a version {} map file".format(path, MAP_VERSION))
+    offset = MAP_HEADER.size
+    palette = [MAP_COLOR.unpack_from(buf, offset + i * MAP_COLOR.size) for i in range(n_colors)]
+    offset += n_colors * MAP_COLOR.size
+    ents = [_unpack_entity(buf, offset + i * MAP_ENTITY.size) for i in range(n_entities)]
+    offset += n_entities * MAP_ENTITY.size
+    offset += _padding(offset)
+
+    cells = buf[offset:offset + w * h * itemsize]
+    if itemsize == 2:
+        cells = cells.cast('H')
+    world = CompactGameWorld.from_buffer(cells, (w, h), cell_size, palette, (bg_r, bg_g, bg_b))
+    offset += w * h * itemsize
+    if df_max_dist > 0:
+        offset += _padding(offset)
+        world.enable_distance_field(df_max_dist).load_values(buf[offset:offset + w * h])
+
+    p = Player(Vector2(px, py), fov=(60, 45), n_rays=n_rays, move_speed=50, turn_speed=160, sight=sight)
+    p.direction = Vector2(dx, dy)
+    return GameState(p, world, ents=ents)
+
+
+TEXT_MAP_COLORS = {
+    '#': (180, 180, 180), '1': (200, 60, 60), '2': (60, 200, 60), '3': (60, 60, 200), '4': (200, 200, 60),
+    '5': (200, 60, 200), '6': (60, 200, 200), '7': (240, 140, 40), '8': (120, 80, 40), '9': (255, 255, 255),
+}
+
+
+def _finish_converted_state(world, player_xy, ents):
+    for e_xy in [e.xy for e in ents] + [player_xy]:
+        cell = world.get_cell_coords_at(e_xy[0], e_xy[1])
+        world.set_cell(cell, None)
+    if world.has_index_grid:
+        world.enable_distance_field()
+    p = Player(player_xy, fov=(60, 45), n_rays=60, move_speed=50, turn_speed=160, sight=200)
+    return GameState(p, world, ents=ents)
+
+
+def state_from_text(lines, cell_size=16):
+    """
+        one character per cell, one line per row: '.' or ' ' is empty, '#' and '1' to '9' are walls
+        (see TEXT_MAP_COLORS), '@' is the player, 'E' an enemy (using ENEMY_TEMPLATES in turn) and '*' a pickup.
+        The player defaults to the center of the map
+    """
+    rows = [line.rstrip('\n') for line in lines]
+    w, h = max(len(row) for row in rows), len(rows)
+    world = CompactGameWorld((w, h), cell_size)
+    player_xy = Vector2(w * cell_size / 2, h * cell_size / 2)
+    ents = []
+    for y, row in enumerate(rows):
+        for x, char in enumerate(row):
+            pos = Vector2(cell_size * (x + 0.5), cell_size * (y + 0.5))
+            if char in TEXT_MAP_COLORS:
+                world.set_cell((x, y), TEXT_MAP_COLORS[char])
+            elif char == '@':
+                player_xy = pos
+            elif char == 'E':
+                n = sum(isinstance(e, Enemy) for e in ents)
+                name, sprite_idx, _, kwargs = ENEMY_TEMPLATES[n % len(ENEMY_TEMPLATES)]
+                if n >= len(ENEMY_TEMPLATES):
+                    name = "{} {}".format(name, n // len(ENEMY_TEMPLATES) + 1)
+                ents.append(Enemy(name, Art.ENEMIES[sprite_idx], pos, sprite_idx=sprite_idx, **kwargs))
+            elif char == '*':
+                n = sum(isinstance(e, Pickup) for e in ents)
+                ents.append(Pickup("Pickup {}".format(n + 1), Art.PICKUPS[n % 4], pos, n % 4))
+    return _finish_converted_state(world, player_xy, ents)
+
+
+def state_from_image(surf, cell_size=16, empty_color=(0, 0, 0)):
+    """one pixel per cell: transparent and `empty_color` pixels are empty, others are walls of their color"""
+    w, h = surf.get_size()
+    world = CompactGameWorld((w, h), cell_size)
+    empty_color = tuple(empty_color[:3])
+    for x in range(w):
+        for y in range(h):
+            color = surf.get_at((x, y))
+            if color.a > 0 and tuple(color)[:3] != empty_color:
+                world.set_cell((x, y), tuple(color)[:3])
+    return _finish_converted_state(world, Vector2(w * cell_size / 2, h * cell_size / 2), [])
+
+
 ############## main.py ##############
 
 
-def run_game():
+def run_game(map_path=None, tick_rate=None):
     """Entry point for packaged web runs"""
-    g = RayCasterGame()
+    g = RayCasterGame(map_path=map_path, tick_rate=tick_rate)
     g.start()
 
 
+def iter_offline_frames(state: GameState, poses, renderer=None, screen_size=(320, 240)):
+    """
+        Renders `state` once per camera pose ((x, y), (dir_x, dir_y), z), without any window.
+        The same Surface is yielded every time, so consumers have to save or copy it before asking for the next one.
+    """
+    renderer = renderer if renderer is not None else RayCastRenderer3D()
+    screen = pygame.Surface(screen_size)
+    player = state.player
+    for xy, direction, z in poses:
+        player.xy = Vector2(xy)
+        player.direction = Vector2(direction).normalize()
+        player.z = z
+        state.update_ray_states()
+        screen.fill((0, 0, 0))
+        renderer.render(screen, state)
+        yield screen
+
+
+def iter_poses_from_file(path):
+    """reads poses lazily from a JSON lines file, e.g. {"xy": [512, 384], "direction": [0, 1], "z": 0}"""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                pose = json.loads(line)
+                yield pose['xy'], pose['direction'], pose.get('z', 0)
+
+
+def save_png_sequence(frames, path_pattern):
+    """path_pattern is formatted with the frame index, e.g. 'out/frame_{:05d}.png'. Returns the number of frames"""
+    n = 0
+    for frame in frames:
+        pygame.image.save(frame, path_pattern.format(n))
+        n += 1
+    return n
+
+
+def write_raw_frames(frames, fileobj):
+    """writes frames back to back as raw RGB24 bytes. Returns the number of frames"""
+    n = 0
+    for frame in frames:
+        fileobj.write(pygame.image.tostring(frame, 'RGB'))
+        n += 1
+    return n
+
+
+def run_offline(poses, out, seed=None, grid_dims=(64, 48), cell_size=16, screen_size=(320, 240), mode='3d',
+                n_rays=None, sight=200, n_enemies=4, n_stars=4, raw=False, n_workers=None):
+    """
+        Entry point for batch renders, no window is opened: renders a map seeded with `seed` once per pose.
+        `out` is a PNG path pattern (see save_png_sequence), or the path of a raw RGB24 stream when raw is True.
+        mode is '2d', '3d' or '3d_buffer' (ColumnBufferRenderer3D, needs numpy).
+        When n_workers is set, rays are cast over that many worker processes (see ParallelRayCaster).
+        Entities get their sprites only if Art was loaded beforehand.
+    """
+    if seed is not None:
+        random.seed(seed)
+    state = build_game_state(grid_dims, cell_size, n_enemies=n_enemies, n_stars=n_stars,
+                             n_rays=n_rays or screen_size[0], sight=sight)
+    if mode == '2d':
+        renderer = RayCastRenderer()
+    elif mode == '3d_buffer':
+        renderer = ColumnBufferRenderer3D()
+    else:
+        renderer = RayCastRenderer3D()
+
+    if n_workers:
+        state.enable_parallel_casting(n_workers)
+    try:
+        frames = iter_offline_frames(state, poses, renderer, screen_size)
+        if raw:
+            with open(out, 'wb') as f:
+                return write_raw_frames(frames, f)
+        return save_png_sequence(frames, out)
+    finally:
+        state.close()
+
+
 if __name__ == '__main__':
     """Entry point for offline runs"""
     run_game()
@@ -0,0 +1,89 @@
+"""
+Converts a text or image map to the binary format loaded by main.load_map (see state_from_text / state_from_image
+for the input formats), or re-saves a random map:
+
+    python mapconv.py level.txt level.rcm
+    python mapconv.py level.png level.rcm --cell-size 32
+    python mapconv.py --random 1024 1024 --seed 7 big.rcm
+    python mapconv.py level.txt level.rcm --check   # also checks that the map survives a load/save/load round trip
+"""
+import argparse
+import os
+import random
+import sys
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import main
+
+pygame = main.pygame
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Map converter for the raycaster")
+    parser.add_argument('src', nargs='?', help="text map (.txt) or image map (any format pygame can load)")
+    parser.add_argument('dst', help="binary map to write")
+    parser.add_argument('--cell-size', type=int, default=16)
+    parser.add_argument('--empty-color', type=int, nargs=3, default=(0, 0, 0), metavar=('R', 'G', 'B'),
+                        help="image maps only: color of the empty cells")
+    parser.add_argument('--random', type=int, nargs=2, metavar=('W', 'H'), help="generate a random map instead")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-distance-field', action='store_true', help="don't store the distance field")
+    parser.add_argument('--check', action='store_true',
+                        help="load the written map, save it back over itself, and check it loads the same")
+    return parser.parse_args(argv)
+
+
+def describe_state(state):
+    """what a map file stores about a GameState, in comparable form"""
+    world = state.world
+    df = world.distance_field
+    return {
+        'dims': world.get_dims(),
+        'cells': [world.get_cell(xy) for xy in world.all_cells()],
+        'distance_field': bytes(df.values) if df is not None else None,
+        'player': (tuple(state.player.xy), tuple(state.player.direction)),
+        'entities': [(type(e).__name__, e.name, e.sprite_idx, tuple(e.xy)) for e in state.entities],
+    }
+
+
+def check_round_trip(path):
+    """loads `path`, saves it back over itself and loads it again. Returns the names of the parts that differ"""
+    first = describe_state(main.load_map(path))
+    main.save_map(main.load_map(path), path)
+    second = describe_state(main.load_map(path))
+    return [key for key in first if first[key] != second[key]]
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    if args.random:
+        if args.seed is not None:
+            random.seed(args.seed)
+        state = main.build_game_state(tuple(args.random), args.cell_size)
+    elif args.src is None:
+        print("either a source map or --random is needed")
+        return 2
+    elif args.src.endswith('.txt'):
+        with open(args.src) as f:
+            state = main.state_from_text(f, args.cell_size)
+    else:
+        state = main.state_from_image(pygame.image.load(args.src), args.cell_size, args.empty_color)
+
+    if args.no_distance_field:
+        state.world.distance_field = None
+    main.save_map(state, args.dst)
+    w, h = state.world.get_dims()
+    print("{}: {}x{} cells, {} entities".format(args.dst, w, h, len(state.entities)))
+    if args.check:
+        mismatches = check_round_trip(args.dst)
+        if mismatches:
+            print("round trip FAILED, differences in: {}".format(", ".join(mismatches)))
+            return 1
+        print("round trip ok")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())